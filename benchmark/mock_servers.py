@@ -0,0 +1,426 @@
+#!python3
+
+#
+# Copyright (c) Michael Kelly. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for details.
+#
+
+"""
+Local stand-ins for the Snipe-IT and Mosyle APIs, implementing just the endpoints SnipeSync.py uses.
+Both can add latency to every request, enforce a per minute throttle the way Snipe does and fail a share
+of requests with a 503, so concurrency, rate and circuit breaker settings can be tried out without touching production.
+"""
+
+import base64
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+MODELS = [
+    ("ios", "iPad (9th generation)", "iPad12,1"),
+    ("ios", "iPad Air (5th generation)", "iPad13,16"),
+    ("ios", "iPad Pro (11-inch) (3rd generation)", "iPad13,4"),
+    ("ios", "iPad Pro (12.9-inch) (5th generation)", "iPad13,8"),
+    ("ios", "iPhone 13", "iPhone14,5"),
+    ("ios", "iPhone 15", "iPhone15,4"),
+    ("mac", "MacBook Air (M1, 2020)", "MacBookAir10,1"),
+    ("mac", "MacBook Air (M2, 2022)", "Mac14,2"),
+    ("mac", "MacBook Pro (14-inch, 2023)", "Mac14,5"),
+    ("mac", "iMac (24-inch, M1, 2021)", "iMac21,1"),
+    ("tvos", "Apple TV 4K (2nd generation)", "AppleTV11,1"),
+    ("tvos", "Apple TV 4K (3rd generation)", "AppleTV14,1")
+]
+
+
+def generate_fleet(device_count, seed=1, assigned_ratio=0.7, devices_per_user=2):
+    """
+    Builds a synthetic Mosyle fleet as {os: [device, ...]}, 60% iOS, 35% macOS and 5% tvOS.
+    Most iOS and macOS devices belong to a user, with a few users owning more than one device.
+    """
+    generator = random.Random(seed)
+    user_count = max(1, int(device_count * assigned_ratio / devices_per_user))
+    fleet = {"ios": [], "mac": [], "tvos": []}
+
+    for index in range(device_count):
+        roll = generator.random()
+        os_type = "ios" if roll < 0.6 else "mac" if roll < 0.95 else "tvos"
+        model_name, model_number = generator.choice([(name, number) for model_os, name, number in MODELS
+                                                     if model_os == os_type])
+        serial = f"BENCH{index:07d}"
+        device = {
+            "serial_number": serial,
+            "device_name": f"{model_name.split(' (')[0]} {index}",
+            "device_model_name": model_name,
+            "device_model": model_number,
+            "asset_tag": f"A{index:07d}",
+            "open_direct_device_link": f"https://myschool.mosyle.com/devices/{serial}",
+            "os": os_type,
+            # A few of the many other columns Mosyle returns unless the request picks specific_columns
+            "deviceudid": f"{generator.getrandbits(128):032x}",
+            "osversion": generator.choice(["16.7.2", "17.1.1", "17.2", "14.1.2"]),
+            "wifi_mac_address": ":".join(f"{generator.randrange(256):02x}" for _ in range(6)),
+            "available_disk": str(generator.randrange(1, 512)),
+            "total_disk": "512",
+            "date_last_beat": str(1700000000 + index)
+        }
+        if os_type != "tvos" and generator.random() < assigned_ratio:
+            user = generator.randrange(user_count)
+            device['useremail'] = f"user{user}@example.com"
+            device['username'] = f"Bench User {user}"
+        fleet[os_type].append(device)
+
+    return fleet
+
+
+class MockServer(ThreadingHTTPServer):
+    """
+    Shared plumbing for the mock APIs: request counting, artificial latency and a fixed window per minute
+    throttle that answers 429 with Retry-After and X-RateLimit headers, like Laravel's throttle middleware.
+    """
+
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, port=0, latency=0.0, jitter=0.0, throttle_per_minute=0, retry_after=True, error_rate=0.0):
+        super().__init__(("127.0.0.1", port), MockRequestHandler)
+        self.latency = latency
+        self.jitter = jitter
+        # Can be changed while the server runs, to simulate an outage starting or ending
+        self.error_rate = error_rate
+        self.throttle_per_minute = throttle_per_minute
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.window_started = time.monotonic()
+        self.window_requests = 0
+        self.request_counts = {}
+        self.throttled = 0
+        self.errors = 0
+        self.thread = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    @property
+    def total_requests(self):
+        with self.lock:
+            return sum(self.request_counts.values())
+
+    def reset_counters(self):
+        with self.lock:
+            self.request_counts = {}
+            self.throttled = 0
+            self.errors = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def check_throttle(self):
+        # Returns (allowed, headers) for a fixed one minute window
+        if self.throttle_per_minute <= 0:
+            return True, {}
+
+        with self.lock:
+            now = time.monotonic()
+            if now - self.window_started >= 60:
+                self.window_started = now
+                self.window_requests = 0
+            self.window_requests += 1
+            remaining = max(0, self.throttle_per_minute - self.window_requests)
+            headers = {
+                "X-RateLimit-Limit": str(self.throttle_per_minute),
+                "X-RateLimit-Remaining": str(remaining)
+            }
+            if self.window_requests <= self.throttle_per_minute:
+                return True, headers
+
+            self.throttled += 1
+            if self.retry_after:
+                headers['Retry-After'] = str(max(1, int(60 - (now - self.window_started)) + 1))
+            return False, headers
+
+    def handle_api(self, method, path, query, body):
+        raise NotImplementedError
+
+
+class MockRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out as separate writes, with Nagle on every keep-alive request waits for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle_method(self, method):
+        server = self.server
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length > 0 else {}
+
+        if server.latency > 0 or server.jitter > 0:
+            time.sleep(server.latency + random.uniform(0, server.jitter))
+
+        key = f"{method} {re.sub(r'/(?:[0-9]+|BENCH[0-9]+)(?=/|$)', '/{id}', url.path)}"
+        with server.lock:
+            server.request_counts[key] = server.request_counts.get(key, 0) + 1
+
+        allowed, headers = server.check_throttle()
+        if allowed and server.error_rate > 0 and random.random() < server.error_rate:
+            with server.lock:
+                server.errors += 1
+            status, payload = 503, {"status": "error", "messages": "Service Unavailable"}
+        elif allowed:
+            status, payload, extra_headers = server.handle_api(method, url.path, parse_qs(url.query), body)
+            headers.update(extra_headers)
+        else:
+            status, payload = 429, {"status": "error", "messages": "Too Many Requests"}
+
+        content = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        self.handle_method("GET")
+
+    def do_POST(self):
+        self.handle_method("POST")
+
+    def do_PATCH(self):
+        self.handle_method("PATCH")
+
+
+class MockSnipeServer(MockServer):
+    """
+    In-memory Snipe-IT /api/v1 with hardware, users and models. List endpoints cap the page size at
+    max_results like Snipe's MAX_RESULTS, and rows are shaped like Snipe's API transformers.
+    """
+
+    def __init__(self, max_results=500, **kwargs):
+        super().__init__(**kwargs)
+        self.max_results = max_results
+        self.data_lock = threading.Lock()
+        self.assets = {}
+        self.users = {}
+        self.models = {}
+        self.next_id = {"assets": 1, "users": 1, "models": 1}
+
+    def allocate_id(self, table):
+        with self.data_lock:
+            new_id = self.next_id[table]
+            self.next_id[table] += 1
+            return new_id
+
+    @staticmethod
+    def timestamp():
+        now = datetime.now()
+        return {"datetime": now.strftime("%Y-%m-%d %H:%M:%S.%f"), "formatted": now.strftime("%Y-%m-%d %I:%M %p")}
+
+    @staticmethod
+    def success(payload, messages="Success"):
+        return 200, {"status": "success", "messages": messages, "payload": payload}, {}
+
+    @staticmethod
+    def error(messages, status=200):
+        return status, {"status": "error", "messages": messages, "payload": None}, {}
+
+    def page(self, records, query, to_row):
+        # Only the requested slice is turned into rows, so paging through 100k assets stays cheap
+        limit = min(int(query.get('limit', ["50"])[0]), self.max_results)
+        offset = int(query.get('offset', ["0"])[0])
+        return 200, {"total": len(records), "rows": [to_row(record) for record in records[offset:offset + limit]]}, {}
+
+    def asset_row(self, asset):
+        assigned_to = None
+        if asset['assigned_to'] is not None:
+            user = self.users[asset['assigned_to']]
+            assigned_to = {"id": user['id'], "username": user['username'], "name": user['name'],
+                           "email": user['email'], "type": "user"}
+        return {
+            "id": asset['id'],
+            "name": asset['name'],
+            "asset_tag": asset['asset_tag'],
+            "serial": asset['serial'],
+            "model": {"id": asset['model_id'], "name": self.models[asset['model_id']]['name']}
+            if asset['model_id'] in self.models else None,
+            "notes": asset['notes'],
+            "assigned_to": assigned_to,
+            "updated_at": asset['updated_at']
+        }
+
+    def model_row(self, model):
+        return {
+            "id": model['id'],
+            "name": model['name'],
+            "model_number": model['model_number'],
+            "notes": model['notes'],
+            "manufacturer": {"id": model['manufacturer_id'], "name": "Apple"},
+            "category": {"id": model['category_id']}
+        }
+
+    def handle_api(self, method, path, query, body):
+        path = path[len("/api/v1"):] if path.startswith("/api/v1") else path
+
+        if path == "/hardware" and method == "GET":
+            with self.data_lock:
+                # Like Snipe without show_archived_in_list, archived assets are only found by byserial
+                assets = [asset for asset in self.assets.values() if not asset.get('archived')]
+                if query.get('sort', ["id"])[0] == "updated_at":
+                    assets.sort(key=lambda a: a['updated_at']['datetime'],
+                                reverse=query.get('order', ["asc"])[0] == "desc")
+                else:
+                    assets.sort(key=lambda a: a['id'])
+                return self.page(assets, query, self.asset_row)
+
+        if path == "/hardware" and method == "POST":
+            if body.get('model_id') not in self.models:
+                return self.error({"model_id": ["The selected model id is invalid."]})
+            asset = {
+                "id": self.allocate_id("assets"),
+                "name": body.get('name'),
+                "asset_tag": body.get('asset_tag'),
+                "serial": body.get('serial'),
+                "model_id": body.get('model_id'),
+                "notes": body.get('notes'),
+                "assigned_to": None,
+                "updated_at": self.timestamp()
+            }
+            with self.data_lock:
+                self.assets[asset['id']] = asset
+            return self.success(dict(asset, updated_at=asset['updated_at']['datetime']))
+
+        match = re.fullmatch(r"/hardware/byserial/(.+)", path)
+        if match and method == "GET":
+            with self.data_lock:
+                rows = [self.asset_row(asset) for asset in self.assets.values()
+                        if (asset['serial'] or "").upper() == match.group(1).upper()]
+            if len(rows) == 0:
+                return self.error("Asset does not exist.")
+            return 200, {"total": len(rows), "rows": rows}, {}
+
+        match = re.fullmatch(r"/hardware/([0-9]+)(/checkin|/checkout)?", path)
+        if match:
+            asset_id = int(match.group(1))
+            with self.data_lock:
+                asset = self.assets.get(asset_id)
+                if asset is None:
+                    return self.error("Asset does not exist.", 404)
+
+                if match.group(2) is None and method == "PATCH":
+                    if 'model_id' in body and body['model_id'] not in self.models:
+                        return self.error({"model_id": ["The selected model id is invalid."]})
+                    for key in ["name", "asset_tag", "serial", "model_id", "notes"]:
+                        if key in body:
+                            asset[key] = body[key]
+                    asset['updated_at'] = self.timestamp()
+                    return self.success(dict(asset, updated_at=asset['updated_at']['datetime']))
+
+                if match.group(2) == "/checkin" and method == "POST":
+                    if asset['assigned_to'] is None:
+                        return self.error("That asset is already checked in.")
+                    asset['assigned_to'] = None
+                    asset['updated_at'] = self.timestamp()
+                    return self.success({"asset": asset['asset_tag']}, "Asset checked in successfully.")
+
+                if match.group(2) == "/checkout" and method == "POST":
+                    if asset['assigned_to'] is not None:
+                        return self.error("That asset is not available for checkout!")
+                    if body.get('assigned_user') not in self.users:
+                        return self.error("Invalid user.")
+                    asset['assigned_to'] = body['assigned_user']
+                    asset['updated_at'] = self.timestamp()
+                    return self.success({"asset": asset['asset_tag']}, "Asset checked out successfully.")
+
+        if path == "/users" and method == "GET":
+            with self.data_lock:
+                users = sorted(self.users.values(), key=lambda u: u['id'])
+                if 'email' in query:
+                    users = [user for user in users if user['email'].lower() == query['email'][0].lower()]
+                    users.reverse()
+            return self.page(users, query, dict)
+
+        if path == "/users" and method == "POST":
+            user = {
+                "id": self.allocate_id("users"),
+                "username": body.get('username'),
+                "name": f"{body.get('first_name')} {body.get('last_name')}",
+                "email": body.get('email')
+            }
+            with self.data_lock:
+                self.users[user['id']] = user
+            return self.success(user)
+
+        if path == "/models" and method == "GET":
+            with self.data_lock:
+                models = sorted(self.models.values(), key=lambda m: m['id'])
+            if 'search' in query:
+                models = [model for model in models if query['search'][0].lower() in model['name'].lower()]
+            return self.page(models, query, self.model_row)
+
+        if path == "/models" and method == "POST":
+            model = {
+                "id": self.allocate_id("models"),
+                "name": body.get('name'),
+                "model_number": body.get('model_number'),
+                "notes": body.get('notes'),
+                "category_id": body.get('category_id'),
+                "manufacturer_id": body.get('manufacturer_id')
+            }
+            with self.data_lock:
+                self.models[model['id']] = model
+            return self.success(model)
+
+        return self.error("Not found", 404)
+
+
+class MockMosyleServer(MockServer):
+    """
+    Mosyle Manager /v2 login and paged listdevices for a synthetic fleet from generate_fleet().
+    """
+
+    def __init__(self, fleet, jwt_lifetime=3600, **kwargs):
+        super().__init__(**kwargs)
+        self.fleet = fleet
+        self.jwt_lifetime = jwt_lifetime
+
+    def issue_jwt(self):
+        # Unsigned, but with the exp claim a client needs to know when to log in again
+        claims = json.dumps({"exp": int(time.time() + self.jwt_lifetime)}).encode("utf-8")
+        payload = base64.urlsafe_b64encode(claims).decode("ascii").rstrip("=")
+        return f"Bearer eyJhbGciOiJub25lIn0.{payload}.mock"
+
+    def handle_api(self, method, path, query, body):
+        if path == "/v2/login" and method == "POST":
+            return 200, {"status": "OK"}, {"Authorization": self.issue_jwt()}
+
+        if path == "/v2/listdevices" and method == "POST":
+            options = body.get('options', {})
+            devices = self.fleet.get(options.get('os'), [])
+            if options.get('serial_numbers'):
+                serials = set(options['serial_numbers'])
+                devices = [device for device in devices if device['serial_number'] in serials]
+            page = int(options.get('page', 1))
+            page_size = int(options.get('page_size', 50))
+            rows = devices[(page - 1) * page_size:page * page_size]
+            if options.get('specific_columns'):
+                rows = [{column: device[column] for column in options['specific_columns'] if column in device}
+                        for device in rows]
+            response = {"devices": rows, "rows": len(devices), "page_size": page_size, "page": page}
+            return 200, {"status": "OK", "response": response}, {}
+
+        return 404, {"status": "error", "message": "Not found"}, {}
@@ -0,0 +1,158 @@
+#!python3
+
+#
+# Copyright (c) Michael Kelly. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for details.
+#
+
+"""
+Runs SnipeSync.py against local mock Snipe-IT and Mosyle servers for synthetic fleets, and reports
+devices/sec, total requests and requests per device for three runs per fleet size:
+
+    cold       Snipe is empty and there is no local state, the first sync for a new tenant
+    warm       Snipe already has every device but the local sync state is gone, so each device is reconciled
+    no-change  a repeat sync with the local state kept and nothing changed in Mosyle
+
+Example: python3 benchmark/run_benchmark.py --sizes 1000 10000 --snipe-latency 0.02 --workers 8
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from mock_servers import MockMosyleServer, MockSnipeServer, generate_fleet
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "SnipeSync.py")
+
+
+def write_config(work_dir, snipe, mosyle, args):
+    config = {
+        "log_level": args.log_level,
+        "mosyle": {
+            "base_url": f"{mosyle.base_url}/v2",
+            "access_token": "benchmark",
+            "email": "benchmark@example.com",
+            "password": "benchmark",
+            "page_size": args.mosyle_page_size
+        },
+        "snipe": {
+            "base_url": f"{snipe.base_url}/api/v1",
+            "api_token": "benchmark",
+            "requests_per_minute": args.requests_per_minute,
+            "workers": args.workers,
+            "ios_category_id": 2,
+            "macos_category_id": 3,
+            "tvos_category_id": 4,
+            "apple_manufacturer_id": 1,
+            "apple_supplier_id": 1,
+            "default_status_id": 2,
+            "import_ios": True,
+            "import_macos": True,
+            "import_tvos": True,
+            "create_users": True,
+            "checkout_devices": True
+        }
+    }
+    with open(os.path.join(work_dir, "config.json"), "w") as config_file:
+        config_file.write(json.dumps(config, indent=4))
+
+
+def run_sync(work_dir, snipe, mosyle, device_count, scenario):
+    snipe.reset_counters()
+    mosyle.reset_counters()
+
+    started = time.monotonic()
+    process = subprocess.run([sys.executable, SCRIPT], cwd=work_dir)
+    seconds = time.monotonic() - started
+
+    snipe_requests = snipe.total_requests
+    mosyle_requests = mosyle.total_requests
+    return {
+        "devices": device_count,
+        "scenario": scenario,
+        "exit_code": process.returncode,
+        "seconds": round(seconds, 2),
+        "devices_per_second": round(device_count / seconds, 1),
+        "snipe_requests": snipe_requests,
+        "mosyle_requests": mosyle_requests,
+        "requests_per_device": round((snipe_requests + mosyle_requests) / device_count, 3),
+        "throttled": snipe.throttled,
+        "errors": snipe.errors,
+        "snipe_endpoints": dict(snipe.request_counts)
+    }
+
+
+def benchmark_fleet(device_count, args):
+    fleet = generate_fleet(device_count, seed=args.seed)
+    snipe = MockSnipeServer(latency=args.snipe_latency, jitter=args.jitter, throttle_per_minute=args.throttle,
+                            retry_after=not args.no_retry_after, error_rate=args.snipe_error_rate).start()
+    mosyle = MockMosyleServer(fleet, latency=args.mosyle_latency, jitter=args.jitter).start()
+    results = []
+
+    try:
+        with tempfile.TemporaryDirectory(prefix="snipesync-benchmark-") as work_dir:
+            write_config(work_dir, snipe, mosyle, args)
+            results.append(run_sync(work_dir, snipe, mosyle, device_count, "cold"))
+
+            # Snipe keeps everything from the cold run, only the local sync state goes
+            for state_file in os.listdir(work_dir):
+                if state_file.startswith("state.db"):
+                    os.remove(os.path.join(work_dir, state_file))
+            results.append(run_sync(work_dir, snipe, mosyle, device_count, "warm"))
+
+            results.append(run_sync(work_dir, snipe, mosyle, device_count, "no-change"))
+    finally:
+        snipe.stop()
+        mosyle.stop()
+
+    return results
+
+
+def print_results(results):
+    print(f"{'devices':>8} {'scenario':<10} {'seconds':>9} {'devices/s':>10} {'snipe req':>10} {'mosyle req':>11} "
+          f"{'req/device':>11} {'429s':>6} {'503s':>6} {'exit':>5}")
+    for result in results:
+        print(f"{result['devices']:>8} {result['scenario']:<10} {result['seconds']:>9} "
+              f"{result['devices_per_second']:>10} {result['snipe_requests']:>10} {result['mosyle_requests']:>11} "
+              f"{result['requests_per_device']:>11} {result['throttled']:>6} {result['errors']:>6} {result['exit_code']:>5}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark SnipeSync.py against local mock Snipe-IT and Mosyle servers")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000],
+                        help="fleet sizes to run, e.g. 1000 10000 100000")
+    parser.add_argument("--seed", type=int, default=1, help="seed for the synthetic fleet")
+    parser.add_argument("--snipe-latency", type=float, default=0.02, help="seconds added to every Snipe request")
+    parser.add_argument("--mosyle-latency", type=float, default=0.1, help="seconds added to every Mosyle request")
+    parser.add_argument("--jitter", type=float, default=0.0, help="up to this many extra random seconds per request")
+    parser.add_argument("--throttle", type=int, default=0,
+                        help="Snipe requests allowed per minute before answering 429, 0 for no throttle")
+    parser.add_argument("--no-retry-after", action="store_true", help="leave Retry-After off the 429 responses")
+    parser.add_argument("--snipe-error-rate", type=float, default=0.0,
+                        help="share of Snipe requests answered with a 503, e.g. 0.05")
+    parser.add_argument("--workers", type=int, default=8, help="SnipeSync workers setting")
+    parser.add_argument("--requests-per-minute", type=int, default=0, help="SnipeSync requests_per_minute setting")
+    parser.add_argument("--mosyle-page-size", type=int, default=500, help="SnipeSync Mosyle page_size setting")
+    parser.add_argument("--log-level", default="WARNING", help="SnipeSync log_level setting")
+    parser.add_argument("--output", help="also write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = []
+    for device_count in args.sizes:
+        results += benchmark_fleet(device_count, args)
+
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(json.dumps(results, indent=4))
+
+    if any(result['exit_code'] != 0 for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,12 @@
+#
+# Copyright (c) Michael Kelly. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for details.
+#
+
+from mosyletosnipe.cli import load_config, main
+from mosyletosnipe.metrics import SyncMetrics
+from mosyletosnipe.mosyle import MosyleClient
+from mosyletosnipe.snipe import SnipeClient, SnipeInventory
+from mosyletosnipe.state import SyncStateStore
+from mosyletosnipe.sync import PLATFORMS, SnipeSync
+from mosyletosnipe.tenants import run_tenants, tenant_configs
@@ -0,0 +1,8 @@
+#
+# Copyright (c) Michael Kelly. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for details.
+#
+
+from mosyletosnipe.cli import main
+
+main()
@@ -0,0 +1,155 @@
+#
+# Copyright (c) Michael Kelly. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for details.
+#
+
+import argparse
+import functools
+import json
+import os
+import signal
+import sys
+import time
+from loguru import logger
+
+from mosyletosnipe.sync import PLATFORMS, SnipeSync
+from mosyletosnipe.tenants import report_tenants, run_tenants, tenant_configs
+
+
+def load_config(path):
+    if not os.path.exists(path):
+        raise Exception(f"Unable to find {path}!")
+    with open(path, "r") as config_file:
+        return json.loads(config_file.read())
+
+
+def configure_logging(config):
+    if 'log_level' in config.keys():
+        logger.remove()
+        logger.add(sys.stdout, level=config['log_level'])
+
+
+def run_sync(sync, args):
+    # Runs the sync the command line asked for, returns its exit code and per platform results
+    if args.serial:
+        results = sync.sync_serials(args.serial, args.platform)
+    elif args.user_email:
+        results = sync.sync_user(args.user_email, args.platform)
+    else:
+        results = sync.sync_all(args.platform, args.full_reconcile, args.resume)
+
+    # A helpdesk re-sync of a few devices should say when one of them didn't make it
+    if (args.serial or args.user_email) and any(stats['failed'] > 0 for stats in results.values()):
+        return 1, results
+    if sync.aborted or len(sync.incomplete) > 0:
+        return 1, results
+    # Stopped part way through, cron or systemd should know that a --resume is due
+    if sync.stopping.is_set() and sync.checkpoint_kept:
+        return 1, results
+    return 0, results
+
+
+def run_tenant(name, config, connection, config_dir, args):
+    # Runs in a process of its own, so the tenant's clients, caches and rate budget are never shared with another
+    logger.configure(patcher=lambda record: record.update(message=f"[{name}] {record['message']}"))
+    configure_logging(config)
+    started = time.monotonic()
+    report = {"tenant": name, "exit_code": 1, "results": {}, "error": None, "aborted": False}
+    sync = None
+    try:
+        sync = SnipeSync(config, config_dir)
+        # Replace the handlers inherited from the parent, which stop every tenant
+        if not (args.serial or args.user_email):
+            signal.signal(signal.SIGTERM, lambda signum, frame: sync.stop())
+            signal.signal(signal.SIGINT, lambda signum, frame: sync.stop())
+        else:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+        report['exit_code'], report['results'] = run_sync(sync, args)
+        report['aborted'] = sync.aborted
+    except Exception as e:
+        logger.error(e)
+        report['error'] = str(e)
+    finally:
+        if sync is not None:
+            sync.close()
+    report['seconds'] = round(time.monotonic() - started, 1)
+    connection.send(report)
+    connection.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="SnipeSync.py", description="Sync device data from Mosyle Manager to Snipe-IT")
+    parser.add_argument("--config", default="config.json",
+                        help="config file to use, state and cache files are kept next to it (default: config.json)")
+    parser.add_argument("--platform", action="append", choices=[platform['key'] for platform in PLATFORMS],
+                        help="only sync this platform, can be given more than once")
+    parser.add_argument("--serial", action="append",
+                        help="only sync the device with this serial number, can be given more than once")
+    parser.add_argument("--user-email", help="only sync the devices assigned to this user in Mosyle")
+    parser.add_argument("--full-reconcile", action="store_true",
+                        help="check every device against Snipe, even if it is unchanged since the last sync")
+    parser.add_argument("--resume", action="store_true",
+                        help="carry on from the checkpoint of an interrupted sync, skipping the devices it finished")
+    parser.add_argument("--daemon", action="store_true",
+                        help="keep running and sync every daemon_interval_minutes, until stopped with SIGTERM or Ctrl+C")
+    parser.add_argument("--interval", type=float, help="minutes between syncs in daemon mode, overrides the config")
+    parser.add_argument("--tenant", action="append",
+                        help="with a multi-tenant config, only sync this tenant, can be given more than once")
+    args = parser.parse_args(argv)
+
+    if args.serial and args.user_email:
+        parser.error("--serial and --user-email can't be used together")
+    if (args.daemon or args.resume) and (args.serial or args.user_email):
+        parser.error("--daemon and --resume sync the whole fleet, they can't be used with --serial or --user-email")
+
+    # Load configuration details from file
+    try:
+        config = load_config(args.config)
+    except Exception as e:
+        logger.error(e)
+        sys.exit(1)
+
+    # Set logging level
+    configure_logging(config)
+    config_dir = os.path.dirname(os.path.abspath(args.config))
+
+    if 'tenants' in config:
+        if args.daemon:
+            parser.error("--daemon can't be used with a multi-tenant config, schedule the runs from cron instead")
+        try:
+            tenants = tenant_configs(config, args.tenant)
+        except Exception as e:
+            logger.error(e)
+            sys.exit(1)
+
+        reports = run_tenants(tenants, functools.partial(run_tenant, config_dir=config_dir, args=args),
+                              config.get('max_parallel_tenants', 4))
+        report_path = config.get('tenants_report', "tenants.json")
+        report_tenants(reports, os.path.join(config_dir, report_path) if report_path else None)
+        if any(report['exit_code'] != 0 for report in reports.values()):
+            sys.exit(1)
+        return
+    elif args.tenant:
+        parser.error("--tenant needs a config with a tenants list")
+
+    sync = SnipeSync(config, config_dir)
+    if not (args.serial or args.user_email):
+        # Finish the devices already started and save a checkpoint, rather than dying part way through a checkout
+        signal.signal(signal.SIGTERM, lambda signum, frame: sync.stop())
+        signal.signal(signal.SIGINT, lambda signum, frame: sync.stop())
+
+    try:
+        if args.daemon:
+            sync.run_daemon(args.interval or config.get('daemon_interval_minutes', 15), args.platform,
+                            args.full_reconcile, args.resume)
+            return
+        exit_code, results = run_sync(sync, args)
+    except Exception as e:
+        logger.error(e)
+        sys.exit(1)
+    finally:
+        sync.close()
+
+    if exit_code != 0:
+        sys.exit(exit_code)
@@ -0,0 +1,173 @@
+#
+# Copyright (c) Michael Kelly. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for details.
+#
+
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+
+class SyncMetrics:
+    """
+    Request counts, status codes and latencies per API endpoint, plus the time spent in each phase of the sync.
+    Phases that run on the worker threads add up the time of every worker, so they can exceed the run's wall time.
+    labels are added to every exported Prometheus sample, e.g. the tenant when several syncs share a textfile directory.
+    """
+
+    def __init__(self, labels=None):
+        self.labels = labels or {}
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = {}
+        self.phases = {}
+
+    def reset(self):
+        # A long running process starts every sync with a clean slate
+        with self.lock:
+            self.started = time.time()
+            self.requests = {}
+            self.phases = {}
+
+    @staticmethod
+    def endpoint(path):
+        # Collapse IDs and serial numbers so /hardware/12/checkout and /hardware/34/checkout are one endpoint
+        path = path.split("?")[0]
+        path = re.sub(r"/byserial/[^/]+", "/byserial/{serial}", path)
+        return re.sub(r"/\d+(?=/|$)", "/{id}", path)
+
+    def record_request(self, service, method, path, status, seconds):
+        key = (service, method, self.endpoint(path))
+        with self.lock:
+            entry = self.requests.setdefault(key, {"statuses": {}, "latencies": []})
+            entry['statuses'][str(status)] = entry['statuses'].get(str(status), 0) + 1
+            entry['latencies'].append(seconds)
+
+    @contextmanager
+    def phase(self, name):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0) + time.monotonic() - started
+
+    @staticmethod
+    def percentile(values, percent):
+        ordered = sorted(values)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+    def summary(self, platforms):
+        with self.lock:
+            endpoints = []
+            for (service, method, endpoint), entry in sorted(self.requests.items()):
+                latencies = entry['latencies']
+                endpoints.append({
+                    "service": service,
+                    "method": method,
+                    "endpoint": endpoint,
+                    "requests": len(latencies),
+                    "statuses": dict(entry['statuses']),
+                    "seconds": round(sum(latencies), 3),
+                    "p50": round(self.percentile(latencies, 50), 3),
+                    "p95": round(self.percentile(latencies, 95), 3),
+                    "p99": round(self.percentile(latencies, 99), 3)
+                })
+            return {
+                "started": self.started,
+                "seconds": round(time.time() - self.started, 3),
+                "requests": sum(endpoint['requests'] for endpoint in endpoints),
+                "endpoints": endpoints,
+                "phases": {name: round(seconds, 3) for name, seconds in self.phases.items()},
+                "platforms": platforms
+            }
+
+    def export_json(self, path, summary):
+        with open(f"{path}.tmp", "w") as metrics_file:
+            metrics_file.write(json.dumps(summary, indent=4))
+        os.replace(f"{path}.tmp", path)
+
+    def add_labels(self, line):
+        if line.startswith("#"):
+            return line
+        labels = ",".join(f'{key}="{value}"' for key, value in self.labels.items())
+        name, rest = re.match(r"([a-z_]+)(.*)", line).groups()
+        if rest.startswith("{"):
+            return f"{name}{{{labels},{rest[1:]}"
+        return f"{name}{{{labels}}}{rest}"
+
+    def export_prometheus(self, path, summary):
+        # Textfile collector format, written then renamed so node_exporter never reads half a file
+        lines = [
+            "# HELP snipesync_requests_total API requests made during the last sync.",
+            "# TYPE snipesync_requests_total counter"
+        ]
+        for endpoint in summary['endpoints']:
+            for status, requests_made in endpoint['statuses'].items():
+                lines.append(f'snipesync_requests_total{{service="{endpoint["service"]}",method="{endpoint["method"]}",'
+                             f'endpoint="{endpoint["endpoint"]}",status="{status}"}} {requests_made}')
+
+        lines += [
+            "# HELP snipesync_request_duration_seconds API request latency during the last sync.",
+            "# TYPE snipesync_request_duration_seconds summary"
+        ]
+        for endpoint in summary['endpoints']:
+            labels = f'service="{endpoint["service"]}",method="{endpoint["method"]}",endpoint="{endpoint["endpoint"]}"'
+            for quantile, key in [("0.5", "p50"), ("0.95", "p95"), ("0.99", "p99")]:
+                lines.append(f'snipesync_request_duration_seconds{{{labels},quantile="{quantile}"}} {endpoint[key]}')
+            lines.append(f"snipesync_request_duration_seconds_sum{{{labels}}} {endpoint['seconds']}")
+            lines.append(f"snipesync_request_duration_seconds_count{{{labels}}} {endpoint['requests']}")
+
+        lines += [
+            "# HELP snipesync_phase_seconds Time spent in each phase of the last sync, summed over worker threads.",
+            "# TYPE snipesync_phase_seconds gauge"
+        ]
+        for name, seconds in summary['phases'].items():
+            lines.append(f'snipesync_phase_seconds{{phase="{name}"}} {seconds}')
+
+        lines += [
+            "# HELP snipesync_devices Devices handled by the last sync, by result.",
+            "# TYPE snipesync_devices gauge"
+        ]
+        for platform, stats in summary['platforms'].items():
+            for result in ["devices", "synced", "unchanged", "resumed", "reassigned", "retried", "failed"]:
+                lines.append(f'snipesync_devices{{platform="{platform}",result="{result}"}} {stats[result]}')
+
+        lines += [
+            "# HELP snipesync_platform_seconds Wall time of each platform in the last sync.",
+            "# TYPE snipesync_platform_seconds gauge"
+        ]
+        for platform, stats in summary['platforms'].items():
+            lines.append(f'snipesync_platform_seconds{{platform="{platform}"}} {stats["seconds"]}')
+
+        if 'circuit' in summary:
+            lines += [
+                "# HELP snipesync_circuit_opens Times the Snipe circuit breaker opened during the last sync.",
+                "# TYPE snipesync_circuit_opens gauge",
+                f"snipesync_circuit_opens {summary['circuit']['opens']}",
+                "# HELP snipesync_circuit_paused_seconds Time Snipe requests were held back by the circuit breaker.",
+                "# TYPE snipesync_circuit_paused_seconds gauge",
+                f"snipesync_circuit_paused_seconds {summary['circuit']['paused_seconds']}",
+                "# HELP snipesync_circuit_aborted 1 if the last sync was aborted because Snipe kept failing.",
+                "# TYPE snipesync_circuit_aborted gauge",
+                f"snipesync_circuit_aborted {int(summary['circuit']['aborted'])}"
+            ]
+
+        lines += [
+            "# HELP snipesync_run_seconds Wall time of the last sync.",
+            "# TYPE snipesync_run_seconds gauge",
+            f"snipesync_run_seconds {summary['seconds']}",
+            "# HELP snipesync_last_run_timestamp_seconds When the last sync started.",
+            "# TYPE snipesync_last_run_timestamp_seconds gauge",
+            f"snipesync_last_run_timestamp_seconds {summary['started']}"
+        ]
+
+        if self.labels:
+            lines = [self.add_labels(line) for line in lines]
+
+        with open(f"{path}.tmp", "w") as metrics_file:
+            metrics_file.write("\n".join(lines) + "\n")
+        os.replace(f"{path}.tmp", path)
@@ -0,0 +1,182 @@
+#
+# Copyright (c) Michael Kelly. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for details.
+#
+
+import base64
+import json
+import threading
+import time
+import requests
+from loguru import logger
+
+# The only device columns the sync reads, everything else Mosyle knows about a device is left on the server
+DEVICE_COLUMNS = ["serial_number", "device_name", "device_model_name", "device_model", "asset_tag",
+                  "open_direct_device_link", "useremail", "username"]
+
+
+def split_name(username):
+    name_parts = username.split(" ")
+    if len(name_parts) == 2:
+        return name_parts[0], name_parts[1]
+    elif len(name_parts) == 3:
+        return name_parts[0], name_parts[2]
+    else:
+        return name_parts[0], name_parts[len(name_parts) - 1]
+
+
+class MosyleDevice:
+    """
+    The columns of a Mosyle device that the sync uses, with the user's name already split into first and last name.
+    Slotted, so a large fleet's pages take a fraction of the memory of Mosyle's dicts.
+    """
+
+    __slots__ = DEVICE_COLUMNS + ["first_name", "last_name"]
+
+    def __init__(self, device):
+        for column in DEVICE_COLUMNS:
+            setattr(self, column, device.get(column))
+        self.serial_number = self.serial_number or ""
+        self.useremail = self.useremail or ""
+        self.username = self.username or ""
+        self.first_name, self.last_name = split_name(self.username)
+
+    def to_dict(self):
+        return {column: getattr(self, column) for column in DEVICE_COLUMNS}
+
+
+class MosyleClient:
+    """
+    Minimal Mosyle Manager API client. Devices are listed one page at a time, so the sync can start
+    on the first page while the rest are still being downloaded, and only the DEVICE_COLUMNS are asked for.
+    The JWT is renewed shortly before it expires, or when Mosyle rejects it, so one client can be kept for as long
+    as the process runs.
+    """
+
+    def __init__(self, mosyle_config, metrics):
+        self.config = mosyle_config
+        self.metrics = metrics
+        self.base_url = mosyle_config.get('base_url', "https://managerapi.mosyle.com/v2")
+        self.page_size = mosyle_config.get('page_size', 100)
+        self.timeout = mosyle_config.get('request_timeout', 120)
+        self.jwt_refresh_seconds = mosyle_config.get('jwt_refresh_minutes', 5) * 60
+        self.specific_columns = mosyle_config.get('specific_columns', True)
+        self.jwt_expires_at = None
+        self.jwt_lock = threading.Lock()
+        self.session = requests.Session()
+        self.session.headers.update({
+            "Accept": "application/json",
+            "Content-Type": "application/json",
+            "accessToken": mosyle_config['access_token']
+        })
+
+    def post(self, path, data):
+        if path != "/login" and self.jwt_expiring():
+            self.refresh_jwt()
+
+        response = self.send(path, data)
+        if response.status_code == 401 and path != "/login":
+            # The JWT expired earlier than its exp claim said, log in again and retry once
+            self.refresh_jwt(force=True)
+            response = self.send(path, data)
+        return response
+
+    def send(self, path, data):
+        started = time.monotonic()
+        try:
+            response = self.session.post(f"{self.base_url}{path}", data=json.dumps(data), timeout=self.timeout)
+        except requests.exceptions.RequestException:
+            self.metrics.record_request("mosyle", "POST", path, "error", time.monotonic() - started)
+            raise
+        self.metrics.record_request("mosyle", "POST", path, response.status_code, time.monotonic() - started)
+        return response
+
+    def retrieve_jwt(self):
+        data = {
+            "accessToken": self.config['access_token'],
+            "email": self.config['email'],
+            "password": self.config['password']
+        }
+        response = self.post("/login", data)
+
+        if response.status_code != 200 or 'Authorization' not in response.headers:
+            logger.error(f"Mosyle login returned {response.status_code}; {response.content}")
+            return False
+
+        self.session.headers['Authorization'] = response.headers['Authorization']
+        self.jwt_expires_at = self.jwt_expiry(response.headers['Authorization'])
+        return True
+
+    @staticmethod
+    def jwt_expiry(authorization):
+        # The exp claim of the JWT, without verifying it; None if the token can't be read
+        try:
+            payload = authorization.split(" ")[-1].split(".")[1]
+            claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+            return float(claims['exp'])
+        except (IndexError, KeyError, TypeError, ValueError):
+            return None
+
+    def jwt_expiring(self):
+        return self.jwt_expires_at is not None and time.time() >= self.jwt_expires_at - self.jwt_refresh_seconds
+
+    def refresh_jwt(self, force=False):
+        # Only one thread logs in, the others wait for it and use the new token
+        with self.jwt_lock:
+            if not force and not self.jwt_expiring():
+                return
+            logger.info("Refreshing the Mosyle JWT")
+            if not self.retrieve_jwt():
+                raise Exception("Unable to refresh the Mosyle JWT; Check credentials!")
+
+    def get_device_page(self, os_type, page, serial_numbers=None):
+        data = {
+            "accessToken": self.config['access_token'],
+            "options": {
+                "os": os_type,
+                "page": page,
+                "page_size": self.page_size
+            }
+        }
+        if self.specific_columns:
+            data['options']['specific_columns'] = DEVICE_COLUMNS
+        if serial_numbers:
+            # Let Mosyle do the filtering, a single device sync shouldn't download the whole fleet
+            data['options']['serial_numbers'] = list(serial_numbers)
+        response = self.post("/listdevices", data)
+
+        if response.status_code != 200:
+            logger.error(f"Received Mosyle error when listing {os_type} devices, page {page}")
+            logger.error(f"List error returned {response.status_code}; {response.content}")
+            raise Exception("Mosyle did not return success on this list")
+
+        response_json = json.loads(response.content)
+        if response_json.get('status') != "OK":
+            logger.error(f"Mosyle returned an error listing {os_type} devices: {response_json}")
+            raise Exception("Mosyle returned an error during the list.")
+
+        return response_json['response']
+
+    def iter_device_pages(self, os_type, serial_numbers=None, first_page=1):
+        page = first_page
+        while True:
+            with self.metrics.phase("mosyle_fetch"):
+                result = self.get_device_page(os_type, page, serial_numbers)
+            devices = result.get('devices', [])
+            # Devices without a model haven't finished enrolling, there is nothing to put in Snipe yet
+            records = [MosyleDevice(device) for device in devices if 'device_model_name' in device]
+            if len(records) > 0:
+                yield records
+
+            if len(devices) == 0:
+                return
+            # rows is the total number of devices, when Mosyle sends it. Mosyle may cap page_size, so the page size
+            # it answered with (or the size of this page) counts, not the one we asked for
+            total = int(result.get('rows') or 0)
+            if total > 0:
+                page_size = int(result.get('page_size') or 0) or len(devices)
+                if page * page_size >= total:
+                    return
+            elif len(devices) < self.page_size:
+                return
+            page += 1
@@ -0,0 +1,944 @@
+#
+# Copyright (c) Michael Kelly. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for details.
+#
+
+import json
+import os
+import random
+from collections import deque
+import string
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import quote
+import requests
+from loguru import logger
+from requests.adapters import HTTPAdapter
+
+from mosyletosnipe.util import KeyedLocks, normalize_serial
+
+
+class RateLimiter:
+    """
+    Token bucket shared by every worker thread, limits how many Snipe requests can start per minute.
+    The rate adapts to the server: it is halved on a 429 and slowly raised back towards the configured
+    maximum while the X-RateLimit headers show headroom. A maximum of 0 starts out unlimited.
+    """
+
+    def __init__(self, requests_per_minute, burst=1, min_requests_per_minute=10):
+        self.max_rate = requests_per_minute / 60
+        self.min_rate = min_requests_per_minute / 60
+        self.rate = self.max_rate
+        self.server_rate = 0
+        self.capacity = max(1, burst)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.resume_at = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.resume_at:
+                    wait = self.resume_at - now
+                elif self.rate <= 0:
+                    return
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def throttled(self, retry_after):
+        # Snipe told us to slow down, every worker waits out the Retry-After and the rate is halved
+        with self.lock:
+            now = time.monotonic()
+            already_paused = now < self.resume_at
+            self.resume_at = max(self.resume_at, now + retry_after)
+            if already_paused:
+                # The other requests that were in flight get their 429 too, only slow down once per pause
+                return
+            current = self.rate if self.rate > 0 else (self.server_rate or 1)
+            self.rate = max(self.min_rate, current / 2)
+            self.tokens = 0
+            self.updated = max(now, self.resume_at)
+            logger.warning(f"Snipe is rate limiting us, slowing down to {self.rate * 60:.0f} requests per minute")
+
+    def observe(self, response):
+        try:
+            limit = int(response.headers['X-RateLimit-Limit'])
+            remaining = int(response.headers['X-RateLimit-Remaining'])
+        except (KeyError, ValueError):
+            return
+
+        with self.lock:
+            self.server_rate = limit / 60
+            if self.rate <= 0 or remaining < limit / 2:
+                return
+            # Plenty of headroom left in this window, creep back up by a small step per response
+            ceiling = self.max_rate if self.max_rate > 0 else self.server_rate
+            step = max(self.min_rate, ceiling / 20) / 60
+            self.rate = min(ceiling, self.rate + step)
+
+
+class CircuitBreaker:
+    """
+    Stops the workers from hammering a Snipe that is failing. The circuit opens once error_rate of the last
+    window requests failed with a 5xx or got no answer at all. While it is open, requests wait open_seconds in
+    "pause" mode, or fail straight away in "abort" mode. After the wait one request is let through as a probe,
+    and its result closes the circuit or keeps it open for another open_seconds.
+    A pause longer than max_pause_minutes aborts as well.
+    """
+
+    def __init__(self, error_rate=0.5, window=20, open_seconds=30, mode="pause", max_pause_minutes=30):
+        self.error_rate = error_rate
+        self.window = window
+        self.open_seconds = open_seconds
+        self.mode = mode
+        self.max_pause_seconds = max_pause_minutes * 60
+        self.condition = threading.Condition()
+        self.reset()
+
+    def reset(self):
+        with self.condition:
+            self.results = deque(maxlen=self.window)
+            self.state = "closed"
+            self.opened_at = 0
+            self.open_until = 0
+            self.probing = False
+            self.aborted = False
+            self.cancelled = False
+            self.opens = 0
+            self.paused_seconds = 0
+            self.condition.notify_all()
+
+    def before_request(self):
+        # Returns True if the caller's request is the half-open probe, it has to pass that on to record()
+        with self.condition:
+            while True:
+                if self.aborted:
+                    raise Exception("Snipe kept failing, the sync has been aborted")
+                if self.state == "closed":
+                    return False
+                if self.cancelled:
+                    raise Exception("The sync is stopping, not waiting for Snipe to recover")
+
+                now = time.monotonic()
+                if now - self.opened_at >= self.max_pause_seconds:
+                    logger.error(f"Snipe has been failing for {self.max_pause_seconds / 60:.0f} minutes, aborting the sync")
+                    self.paused_seconds += now - self.opened_at
+                    self.aborted = True
+                    self.condition.notify_all()
+                    continue
+                if self.state == "open" and now >= self.open_until:
+                    logger.info("Checking if Snipe has recovered")
+                    self.state = "half_open"
+                    self.probing = True
+                    return True
+
+                # Wait for the pause to end, or for the probe in flight to come back
+                self.condition.wait(max(0.1, self.open_until - now) if self.state == "open" else 1)
+
+    def record(self, ok, probe=False):
+        with self.condition:
+            now = time.monotonic()
+            if probe:
+                self.probing = False
+                if ok:
+                    logger.info(f"Snipe has recovered after {now - self.opened_at:.0f}s, carrying on")
+                    self.paused_seconds += now - self.opened_at
+                    self.state = "closed"
+                    self.results.clear()
+                else:
+                    self.state = "open"
+                    self.open_until = now + self.open_seconds
+                    logger.warning(f"Snipe is still failing, waiting another {self.open_seconds}s")
+                self.condition.notify_all()
+                return
+
+            # Requests that were already in flight when the circuit opened don't count
+            if self.state != "closed":
+                return
+            self.results.append(ok)
+            failures = self.results.count(False)
+            if len(self.results) < self.window or failures < self.error_rate * self.window:
+                return
+
+            self.state = "open"
+            self.opened_at = now
+            self.open_until = now + self.open_seconds
+            self.opens += 1
+            if self.mode == "abort":
+                logger.error(f"{failures} of the last {self.window} Snipe requests failed, aborting the sync")
+                self.aborted = True
+            else:
+                logger.warning(f"{failures} of the last {self.window} Snipe requests failed, "
+                               f"pausing for {self.open_seconds}s")
+            self.condition.notify_all()
+
+    def cancel(self):
+        with self.condition:
+            self.cancelled = True
+            self.condition.notify_all()
+
+    def summary(self):
+        with self.condition:
+            paused = self.paused_seconds
+            if self.state != "closed" and not self.aborted:
+                paused += time.monotonic() - self.opened_at
+            return {"state": self.state, "opens": self.opens, "paused_seconds": round(paused, 1),
+                    "aborted": self.aborted}
+
+
+class SnipeClient:
+    """
+    All Snipe API calls go through here: one pooled keep-alive session shared by every worker thread,
+    paced by a shared RateLimiter and retried when Snipe throttles us or has a transient error.
+    A CircuitBreaker holds every request back while Snipe is failing.
+    """
+
+    IDEMPOTENT_METHODS = ["GET", "PATCH"]
+    RETRY_STATUS_CODES = [429, 502, 503, 504]
+
+    def __init__(self, snipe_config, metrics, workers=1, connections=None):
+        self.config = snipe_config
+        self.metrics = metrics
+        self.base_url = snipe_config['base_url']
+        self.timeout = snipe_config.get('request_timeout', 60)
+
+        # Older configs only have the per device rate_limit sleep, so derive a request rate from it
+        requests_per_minute = snipe_config.get('requests_per_minute')
+        if requests_per_minute is None:
+            requests_per_minute = 60 / snipe_config['rate_limit'] if snipe_config.get('rate_limit', 0) > 0 else 0
+        self.rate_limiter = RateLimiter(requests_per_minute, snipe_config.get('rate_limit_burst', workers),
+                                        snipe_config.get('min_requests_per_minute', 10))
+        self.breaker = CircuitBreaker(snipe_config.get('circuit_error_rate', 0.5), snipe_config.get('circuit_window', 20),
+                                      snipe_config.get('circuit_open_seconds', 30), snipe_config.get('circuit_mode', "pause"),
+                                      snipe_config.get('circuit_max_pause_minutes', 30))
+
+        # One connection per worker thread (connections, if the workers of several platforms share the client),
+        # blocking when they are all in use rather than opening throwaway ones
+        pool_size = snipe_config.get('pool_size', connections or workers)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "Accept": "application/json",
+            "Content-Type": "application/json",
+            "Accept-Encoding": "gzip, deflate" if snipe_config.get('gzip', True) else "identity",
+            "Connection": "keep-alive",
+            "Authorization": f"Bearer {snipe_config['api_token']}"
+        })
+
+    def retry_delay(self, attempt, response=None):
+        # Honour Retry-After when Snipe sends one, otherwise jittered exponential backoff
+        if response is not None and 'Retry-After' in response.headers:
+            retry_after = response.headers['Retry-After']
+            try:
+                return max(0, float(retry_after))
+            except ValueError:
+                try:
+                    return max(0, (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds())
+                except (TypeError, ValueError):
+                    pass
+
+        delay = min(self.config.get('retry_backoff_max', 60), self.config.get('retry_backoff', 1) * 2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def request(self, method, path, data=None):
+        max_retries = self.config.get('max_retries', 5)
+        attempt = 0
+        while True:
+            probe = self.breaker.before_request()
+            self.rate_limiter.acquire()
+            started = time.monotonic()
+            try:
+                response = self.session.request(method, f"{self.base_url}{path}", timeout=self.timeout,
+                                                data=None if data is None else json.dumps(data))
+                self.metrics.record_request("snipe", method, path, response.status_code, time.monotonic() - started)
+            except requests.exceptions.RequestException as e:
+                self.metrics.record_request("snipe", method, path, "error", time.monotonic() - started)
+                self.breaker.record(False, probe)
+                # We can't know if a write made it to Snipe, so only reads and PATCHes are safe to repeat
+                if method not in self.IDEMPOTENT_METHODS or attempt >= max_retries:
+                    raise
+                delay = self.retry_delay(attempt)
+                logger.warning(f"Snipe {method} {path} failed ({e}), retrying in {delay:.1f}s")
+            else:
+                # Anything short of a 5xx means Snipe is up, a 429 included
+                self.breaker.record(response.status_code < 500, probe)
+                self.rate_limiter.observe(response)
+                if response.status_code == 429:
+                    # A throttled request was never processed, so any method can be retried
+                    delay = self.retry_delay(attempt, response)
+                    self.rate_limiter.throttled(delay)
+                elif response.status_code in self.RETRY_STATUS_CODES and method in self.IDEMPOTENT_METHODS:
+                    delay = self.retry_delay(attempt, response)
+                else:
+                    return response
+
+                if attempt >= max_retries:
+                    logger.error(f"Snipe {method} {path} still returned {response.status_code} after {max_retries} retries")
+                    return response
+                logger.warning(f"Snipe {method} {path} returned {response.status_code}, retrying in {delay:.1f}s")
+
+            time.sleep(delay)
+            attempt += 1
+
+    def get(self, path):
+        return self.request("GET", path)
+
+    def post(self, path, data):
+        return self.request("POST", path, data)
+
+    def patch(self, path, data):
+        return self.request("PATCH", path, data)
+
+
+class SnipeAssetIndex:
+    """
+    Serial number -> Snipe asset row index, built from a single paged walk of /hardware at startup.
+    Rows are kept up to date from our own create/update/checkout calls for the rest of the run, and refresh()
+    picks up the assets edited in Snipe since. Only the fields the sync reads are kept, a full transformer row
+    is several KB.
+    """
+
+    def __init__(self, snipe):
+        self.snipe = snipe
+        self.loaded = False
+        self.loaded_at = 0
+        self.rows = {}
+        self.serials_by_id = {}
+        # The latest updated_at seen in Snipe, refresh() fetches everything edited since
+        self.newest = None
+
+    @staticmethod
+    def compact(row):
+        assigned_to = row.get('assigned_to')
+        if assigned_to is not None:
+            assigned_to = {"id": assigned_to['id'], "type": assigned_to.get('type', "user")}
+        return {"id": row['id'], "serial": row.get('serial'), "asset_tag": row.get('asset_tag'), "name": row.get('name'),
+                "notes": row.get('notes'), "assigned_to": assigned_to, "updated_at": row.get('updated_at')}
+
+    @staticmethod
+    def updated(row):
+        updated_at = row.get('updated_at')
+        return updated_at.get('datetime') if isinstance(updated_at, dict) else updated_at
+
+    def load(self, page_size):
+        logger.info("Prefetching Snipe assets")
+        rows = {}
+        newest = None
+        offset = 0
+        while True:
+            response = self.snipe.get(f"/hardware?limit={page_size}&offset={offset}&sort=id&order=asc")
+
+            if response.status_code != 200:
+                logger.warning(f"Received Snipe error while prefetching assets at offset {offset}")
+                logger.warning(f"Search error returned {response.status_code}; {response.content}")
+                return False
+
+            response_json = json.loads(response.content)
+            if 'status' in response_json.keys() and response_json['status'] == "error":
+                logger.warning(f"Snipe returned an error while prefetching assets: {response_json['messages']}")
+                return False
+
+            page = response_json.get('rows', [])
+            for row in page:
+                if row.get('serial'):
+                    # Keep the oldest asset for a duplicated serial, like the byserial lookup does
+                    rows.setdefault(normalize_serial(row['serial']), self.compact(row))
+                updated = self.updated(row)
+                if updated is not None and (newest is None or updated > newest):
+                    newest = updated
+
+            offset += len(page)
+            if len(page) == 0 or offset >= response_json.get('total', 0):
+                break
+
+        self.rows = rows
+        self.serials_by_id = {row['id']: serial for serial, row in rows.items()}
+        self.newest = newest
+        self.loaded = True
+        self.loaded_at = time.time()
+        logger.info(f"Prefetched {len(self.rows)} Snipe assets")
+        return True
+
+    def refresh(self, page_size):
+        """
+        Pages through /hardware newest edit first, until it gets back to the last edit already seen, so assets
+        changed in Snipe (by hand or by us) since the last load or refresh are up to date without fetching them all.
+        Deleted assets aren't listed, they are only dropped by the next full load.
+        """
+        if self.newest is None:
+            return self.load(page_size)
+
+        newest = self.newest
+        refreshed = 0
+        offset = 0
+        while True:
+            response = self.snipe.get(f"/hardware?limit={page_size}&offset={offset}&sort=updated_at&order=desc")
+
+            if response.status_code != 200:
+                logger.warning(f"Received Snipe error while refreshing assets at offset {offset}")
+                logger.warning(f"Search error returned {response.status_code}; {response.content}")
+                return False
+
+            response_json = json.loads(response.content)
+            if 'status' in response_json.keys() and response_json['status'] == "error":
+                logger.warning(f"Snipe returned an error while refreshing assets: {response_json['messages']}")
+                return False
+
+            page = response_json.get('rows', [])
+            caught_up = False
+            for row in page:
+                updated = self.updated(row)
+                # Edits in the same second as the newest one we saw may not have made it into the last fetch
+                if updated is not None and updated < self.newest:
+                    caught_up = True
+                    break
+                if updated is not None and updated > newest:
+                    newest = updated
+
+                # The serial may have been edited, forget the asset under its old one
+                previous = self.serials_by_id.get(row['id'])
+                if previous is not None and self.rows.get(previous, {}).get('id') == row['id']:
+                    del self.rows[previous]
+                if row.get('serial'):
+                    existing = self.rows.get(normalize_serial(row['serial']))
+                    if existing is None or existing['id'] >= row['id']:
+                        self.store(row['serial'], row)
+                        if updated is None or updated > self.newest:
+                            refreshed += 1
+
+            offset += len(page)
+            if caught_up or len(page) == 0 or offset >= response_json.get('total', 0):
+                break
+
+        self.newest = newest
+        logger.info(f"Refreshed {refreshed} Snipe assets edited since the last sync")
+        return True
+
+    def get(self, serial_number):
+        return self.rows.get(normalize_serial(serial_number))
+
+    def knows(self, serial_number):
+        # Only a hit can be trusted, /hardware leaves out archived assets so a miss still needs a byserial lookup
+        return normalize_serial(serial_number) in self.rows
+
+    def store(self, serial_number, row):
+        serial = normalize_serial(serial_number)
+        row = self.compact(row)
+        self.rows[serial] = row
+        self.serials_by_id[row['id']] = serial
+        return row
+
+    def discard(self, serial_number):
+        # Something went wrong syncing this asset, so the next lookup asks Snipe rather than trusting our copy
+        self.rows.pop(normalize_serial(serial_number), None)
+
+    def update(self, serial_number, values):
+        row = self.rows[normalize_serial(serial_number)]
+        row.update(values)
+        # We don't get the new timestamp back, so it is unknown until the next prefetch
+        row['updated_at'] = None
+        return row
+
+    def set_assigned_user(self, asset_id, user_id):
+        row = self.rows.get(self.serials_by_id.get(asset_id))
+        if row is None:
+            return
+        row['assigned_to'] = None if user_id == 0 else {"id": user_id, "type": "user"}
+        row['updated_at'] = None
+
+
+class SnipeUserDirectory:
+    """
+    Email -> Snipe user ID index, built from a single paged walk of /users at startup.
+    Emails are matched case-insensitively, only a miss falls back to a live search.
+    """
+
+    def __init__(self, snipe):
+        self.snipe = snipe
+        self.loaded = False
+        self.loaded_at = 0
+        self.ids = {}
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, page_size):
+        logger.info("Prefetching Snipe users")
+        ids = {}
+        offset = 0
+        while True:
+            response = self.snipe.get(f"/users?limit={page_size}&offset={offset}&sort=id&order=asc")
+
+            if response.status_code != 200:
+                logger.warning(f"Received Snipe error while prefetching users at offset {offset}")
+                logger.warning(f"Search error returned {response.status_code}; {response.content}")
+                return False
+
+            response_json = json.loads(response.content)
+            if 'status' in response_json.keys() and response_json['status'] == "error":
+                logger.warning(f"Snipe returned an error while prefetching users: {response_json['messages']}")
+                return False
+
+            page = response_json.get('rows', [])
+            for row in page:
+                if row.get('email'):
+                    ids.setdefault(row['email'].strip().lower(), row['id'])
+
+            offset += len(page)
+            if len(page) == 0 or offset >= response_json.get('total', 0):
+                break
+
+        self.ids = ids
+        self.loaded = True
+        self.loaded_at = time.time()
+        logger.info(f"Prefetched {len(self.ids)} Snipe users")
+        return True
+
+    def reset_counts(self):
+        # The hit and miss counts are per sync, the directory itself is kept
+        self.hits = 0
+        self.misses = 0
+
+    def restore(self, ids, loaded_at):
+        # Picks up a directory saved in a sync checkpoint
+        self.ids = dict(ids)
+        self.loaded = True
+        self.loaded_at = loaded_at
+
+    def get(self, email):
+        user_id = self.ids.get(email.strip().lower())
+        if user_id is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return user_id
+
+    def store(self, email, user_id):
+        self.ids[email.strip().lower()] = user_id
+        return user_id
+
+
+class SnipeModelCatalog:
+    """
+    Exact model name / model number -> Snipe model ID for the Apple manufacturer, built from a single paged
+    walk of /models. Saved to disk so runs within the TTL start warm without asking Snipe at all.
+    """
+
+    def __init__(self, snipe, path, ttl_hours):
+        self.snipe = snipe
+        self.path = path
+        self.ttl_hours = ttl_hours
+        self.loaded = False
+        self.loaded_at = 0
+        # Only a catalog fetched from Snipe during this run is known to have every model
+        self.complete = False
+        self.by_name = {}
+        self.by_number = {}
+        self.lock = threading.Lock()
+
+    def load(self, page_size, manufacturer_id, refresh=False):
+        # refresh skips the on-disk cache and fetches every model from Snipe again
+        if not refresh and self.load_from_disk():
+            return True
+
+        logger.info("Prefetching Snipe models")
+        by_name = {}
+        by_number = {}
+        offset = 0
+        while True:
+            response = self.snipe.get(f"/models?limit={page_size}&offset={offset}&sort=id&order=asc")
+
+            if response.status_code != 200:
+                logger.warning(f"Received Snipe error while prefetching models at offset {offset}")
+                logger.warning(f"Search error returned {response.status_code}; {response.content}")
+                return False
+
+            response_json = json.loads(response.content)
+            if 'status' in response_json.keys() and response_json['status'] == "error":
+                logger.warning(f"Snipe returned an error while prefetching models: {response_json['messages']}")
+                return False
+
+            page = response_json.get('rows', [])
+            for row in page:
+                if row.get('manufacturer') is None or row['manufacturer']['id'] != manufacturer_id:
+                    continue
+                # Keep the oldest model when names clash, like the old search did
+                by_name.setdefault(row['name'], row['id'])
+                # Models we created before model_number was set only have it in the notes
+                model_number = row.get('model_number') or row.get('notes')
+                if model_number:
+                    by_number.setdefault(model_number, row['id'])
+
+            offset += len(page)
+            if len(page) == 0 or offset >= response_json.get('total', 0):
+                break
+
+        with self.lock:
+            self.by_name = by_name
+            self.by_number = by_number
+            self.loaded = True
+            self.loaded_at = time.time()
+            self.complete = True
+            self.save()
+        logger.info(f"Prefetched {len(self.by_name)} Snipe models")
+        return True
+
+    def load_from_disk(self):
+        if not self.path or not os.path.exists(self.path):
+            return False
+
+        try:
+            with open(self.path, "r") as cache_file:
+                cache = json.loads(cache_file.read())
+        except (OSError, ValueError) as e:
+            logger.warning(f"Unable to read the model cache {self.path}, it will be rebuilt")
+            logger.debug(e)
+            return False
+
+        # The TTL runs from the last full fetch, adding a model doesn't make the rest of the cache any fresher
+        fetched_at = cache.get('fetched_at', cache.get('saved_at', 0))
+        if time.time() - fetched_at >= self.ttl_hours * 3600:
+            logger.debug("Model cache has expired, it will be rebuilt")
+            return False
+
+        with self.lock:
+            self.by_name = cache['by_name']
+            self.by_number = cache['by_number']
+            self.loaded = True
+            self.loaded_at = fetched_at
+        logger.info(f"Loaded {len(self.by_name)} Snipe models from {self.path}")
+        return True
+
+    def save(self):
+        # Called with the lock held; write then rename so a crash never leaves half a cache behind
+        if not self.path:
+            return
+        cache = {"fetched_at": self.loaded_at, "by_name": self.by_name, "by_number": self.by_number}
+        with open(f"{self.path}.tmp", "w") as cache_file:
+            cache_file.write(json.dumps(cache))
+        os.replace(f"{self.path}.tmp", self.path)
+
+    def find(self, model_name, model_number):
+        model_id = self.by_name.get(model_name)
+        if model_id is None and model_number:
+            model_id = self.by_number.get(model_number)
+        return model_id
+
+    def forget(self, model_id):
+        # Drops a model Snipe no longer has (deleted or merged), it is searched for again before being recreated
+        with self.lock:
+            self.by_name = {name: cached_id for name, cached_id in self.by_name.items() if cached_id != model_id}
+            self.by_number = {number: cached_id for number, cached_id in self.by_number.items()
+                              if cached_id != model_id}
+            self.complete = False
+            self.save()
+
+    def add(self, model_name, model_number, model_id):
+        with self.lock:
+            self.by_name[model_name] = model_id
+            if model_number:
+                self.by_number.setdefault(model_number, model_id)
+            self.save()
+        return model_id
+
+
+class SnipeInventory:
+    """
+    Finds or creates the Snipe users, models and assets for Mosyle devices, and keeps their checkouts in step.
+    Lookups go through the asset, user and model indexes first, and only ask Snipe about what they don't know.
+    """
+
+    def __init__(self, snipe, snipe_config, model_cache_file=None, model_cache_hours=0):
+        self.snipe = snipe
+        self.config = snipe_config
+        self.assets = SnipeAssetIndex(snipe)
+        self.users = SnipeUserDirectory(snipe)
+        self.models = SnipeModelCatalog(snipe, model_cache_file, model_cache_hours)
+        self.locks = KeyedLocks()
+
+    def get_or_create_user(self, first_name, last_name, username, email):
+        if "@" not in email:
+            logger.error(f"Could not find user {email}, since it seems like this isn't an email address.")
+            return 0
+
+        # Only one worker may search for or create a given user at a time, otherwise we'd create duplicates
+        with self.locks.hold(("user", email.strip().lower())):
+            return self._get_or_create_user(first_name, last_name, username, email)
+
+    def _get_or_create_user(self, first_name, last_name, username, email):
+        # Check to see if the user is already cached
+        user_id = self.users.get(email)
+        if user_id is not None:
+            return user_id
+
+        # If not, lets look in Snipe
+        logger.debug(f"Looking user email {email} to see if it already exists in Snipe")
+
+        response = self.snipe.get(f"/users?limit=1&offset=0&sort=created_at&order=desc&email={quote(email)}&deleted=false&all=false")
+
+        if response.status_code != 200 and response.status_code != 404:
+            # error
+            logger.error(f"Received Snipe error when trying to find user {email}")
+            logger.error(f"Search error returned {response.status_code}; {response.content}")
+            raise Exception("Snipe did not return success on this search")
+
+        if response.status_code != 404:
+            response_json = json.loads(response.content)
+
+        if response.status_code == 404 or len(response_json['rows']) == 0:
+            if not self.config['create_users']:
+                logger.warning(f"Could not find user {email}, but creating users is disabled.")
+                # Remember the miss so other devices for this user don't search again
+                return self.users.store(email, 0)
+
+            logger.debug("User does not already exist, creating...")
+            password = ''.join(random.choices(string.ascii_uppercase + string.digits, k=25))
+            data = {
+                "first_name": first_name,
+                "last_name": last_name,
+                "username": username,
+                "password": password,
+                "password_confirmation": password,
+                "email": email,
+                "activated": True
+            }
+            response = self.snipe.post("/users", data)
+
+            if response.status_code == 200 or response.status_code == 201:
+                response_json = json.loads(response.content)
+                row = response_json['payload']
+                if response_json['status'] == "error":
+                    logger.error(response_json['messages'])
+                    raise Exception("Snipe returned an error during the transaction.")
+                logger.debug(f"Created new user {email} in Snipe, new ID is {row['id']}")
+                return self.users.store(email, row['id'])
+            else:
+                logger.error("Problem creating new Snipe user!")
+                raise Exception("Problem creating new Snipe user!")
+        else:
+            row = response_json['rows'][0]
+            logger.debug(f"Matched {email} to Snipe User ID {row['id']}")
+            return self.users.store(email, row['id'])
+
+    def get_or_create_model(self, model_name, model_number, category_id):
+        # Check to see if the model is already cached
+        model_id = self.models.find(model_name, model_number)
+        if model_id is not None:
+            return model_id
+
+        # Models are resolved by the workers as devices arrive, make sure only one of them creates a new model
+        with self.locks.hold(("model", model_name)):
+            return self._get_or_create_model(model_name, model_number, category_id)
+
+    def _get_or_create_model(self, model_name, model_number, category_id):
+        # Check again, another worker may have just added it
+        model_id = self.models.find(model_name, model_number)
+        if model_id is not None:
+            return model_id
+
+        # Someone may have added the model since the on-disk cache was saved, so search before creating a duplicate
+        if not self.models.complete:
+            logger.debug(f"Looking model name {model_name} to see if it already exists in Snipe")
+
+            response = self.snipe.get(f"/models?limit=50&offset=0&search={quote(model_name)}&sort=created_at&order=asc")
+
+            if response.status_code != 200 and response.status_code != 404:
+                # error
+                logger.error(f"Received Snipe error when trying to find model {model_name}")
+                logger.error(f"Search error returned {response.status_code}; {response.content}")
+                raise Exception("Snipe did not return success on this search")
+
+            if response.status_code != 404:
+                response_json = json.loads(response.content)
+                # The search is fuzzy, "iPad Pro" also finds "iPad Pro (12.9-inch)", so only take an exact match
+                for row in response_json.get('rows', []):
+                    if row['name'] == model_name:
+                        logger.debug(f"Matched {model_name} to Snipe Model ID {row['id']}")
+                        return self.models.add(model_name, model_number, row['id'])
+
+        logger.debug("Model name does not already exist, creating...")
+        data = {
+            "name": model_name,
+            "model_number": model_number,
+            "notes": model_number,
+            "category_id": category_id,
+            "manufacturer_id": self.config['apple_manufacturer_id']
+        }
+        response = self.snipe.post("/models", data)
+
+        if response.status_code == 200 or response.status_code == 201:
+            response_json = json.loads(response.content)
+            row = response_json['payload']
+            if response_json['status'] == "error":
+                logger.error(response_json['messages'])
+                raise Exception("Snipe returned an error during the transaction.")
+            logger.debug(f"Created model {model_name} in Snipe, new ID is {row['id']}")
+            return self.models.add(model_name, model_number, row['id'])
+        else:
+            logger.error("Problem creating new Snipe model!")
+            raise Exception("Problem creating new Snipe model!")
+
+    def check_model_rejected(self, messages, model_id):
+        # Snipe rejects a model_id it no longer has, so stop handing out the cached one
+        if isinstance(messages, dict) and 'model_id' in messages:
+            logger.warning(f"Snipe rejected model ID {model_id}, it will be looked up again")
+            self.models.forget(model_id)
+
+    def get_asset(self, serial_number):
+        # Use the prefetched index when we have it, saves a round trip per device
+        if self.assets.knows(serial_number):
+            return self.assets.get(serial_number)
+
+        # Lookup the snipe ID first just in case the asset already exists
+        logger.debug(f"Looking serial number {serial_number} to see if it already exists in Snipe")
+
+        response = self.snipe.get(f"/hardware/byserial/{quote(serial_number)}?deleted=false")
+
+        if response.status_code != 200 and response.status_code != 404:
+            # error
+            logger.warning(f"Received Snipe error when trying to find asset {serial_number}")
+            logger.warning(f"Search error returned {response.status_code}; {response.content}")
+            return None
+
+        if response.status_code != 404:
+            response_json = json.loads(response.content)
+            if 'status' in response_json.keys() and response_json['status'] == "error":
+                return None
+
+            if 'rows' in response_json.keys() and len(response_json['rows']) > 0:
+                row = response_json['rows'][0]
+                return self.assets.store(serial_number, row)
+
+        return None
+
+    def checkin_asset(self, asset_id):
+        data = {
+            "status_id": self.config['default_status_id'],
+            "note": "Automated checkin by Mosyle->Snipe sync"
+        }
+        logger.debug(f"Checking in asset id {asset_id}")
+        response = self.snipe.post(f"/hardware/{asset_id}/checkin", data)
+
+        if response.status_code == 200 or response.status_code == 201:
+            response_json = json.loads(response.content)
+            if response_json['status'] == "error":
+                # Our copy of the asset was out of date, that's fine
+                if response_json['messages'] == "That asset is already checked in.":
+                    logger.debug("Asset is already checked in.")
+                    self.assets.set_assigned_user(asset_id, 0)
+                    return True
+
+                logger.error(response_json['messages'])
+                raise Exception("Snipe returned an error during the transaction.")
+            self.assets.set_assigned_user(asset_id, 0)
+            return True
+        else:
+            logger.error("Problem checking in snipe asset!")
+            raise Exception("Problem checking in snipe asset!")
+
+    def checkout_asset(self, asset_id, user_id):
+        data = {
+            "checkout_to_type": "user",
+            "status_id": self.config['default_status_id'],
+            "assigned_user": user_id,
+            "note": "Automated checkout by Mosyle->Snipe sync"
+        }
+        logger.debug(f"Checking out asset id {asset_id} to {user_id}")
+        response = self.snipe.post(f"/hardware/{asset_id}/checkout", data)
+
+        if response.status_code == 200 or response.status_code == 201:
+            response_json = json.loads(response.content)
+            if response_json['status'] == "error":
+                logger.error(response_json['messages'])
+                raise Exception("Snipe returned an error during the transaction.")
+            self.assets.set_assigned_user(asset_id, user_id)
+            return True
+        else:
+            logger.error("Problem checking out snipe asset!")
+            raise Exception("Problem checking out snipe asset!")
+
+    def sync_assignment(self, row, user_id):
+        """
+        Makes the asset's checkout match the wanted Snipe user (0 for nobody), going by the assigned_to of the asset
+        row we already have. Returns True if anything had to be changed in Snipe.
+        """
+        assigned_to = row.get('assigned_to')
+
+        if user_id == 0:
+            if assigned_to is None:
+                logger.debug(f"Asset id {row['id']} is already checked in.")
+                return False
+            self.checkin_asset(row['id'])
+            return True
+
+        if assigned_to is not None and assigned_to.get('type', "user") == "user" and assigned_to['id'] == user_id:
+            logger.debug(f"Asset id {row['id']} is already correctly checked out.")
+            return False
+
+        # Snipe won't check out an asset that is still assigned to someone (or something) else
+        if assigned_to is not None:
+            self.checkin_asset(row['id'])
+        logger.info(f"Checking asset id {row['id']} out to Snipe user {user_id}.")
+        self.checkout_asset(row['id'], user_id)
+        return True
+
+    def create_or_update_asset(self, serial_number, data):
+        # Lookup the snipe ID first just in case the asset already exists
+        row = self.get_asset(serial_number)
+
+        if row is None:
+            logger.debug("Asset does not already exist, creating...")
+            response = self.snipe.post("/hardware", data)
+
+            if response.status_code == 200 or response.status_code == 201:
+                response_json = json.loads(response.content)
+                row = response_json['payload']
+                if response_json['status'] == "error":
+                    logger.error(response_json['messages'])
+                    self.check_model_rejected(response_json['messages'], data['model_id'])
+                    raise Exception("Snipe returned an error during the transaction.")
+                logger.info(f"Created new asset {data['asset_tag']} with serial {serial_number} and ID {row['id']}")
+                # The create payload is the raw model, a brand new asset is never assigned
+                return self.assets.store(serial_number, dict(row, assigned_to=None, updated_at=None))
+            else:
+                logger.error("Problem creating new Snipe asset!")
+                raise Exception("Problem creating new Snipe asset!")
+        else:
+            values_changed = False
+            # Check these keys for changes only
+            for key in ["asset_tag", "notes", "name"]:
+                if key == "notes" and data[key] in row[key]:
+                    continue
+                if row[key] != data[key]:
+                    values_changed = True
+
+            if values_changed:
+                logger.debug(f"Asset already exists in snipe as ID {row['id']}, proceeding with update")
+                response = self.snipe.patch(f"/hardware/{row['id']}", data)
+
+                if response.status_code == 200 or response.status_code == 201:
+                    response_json = json.loads(response.content)
+                    if response_json['status'] == "error":
+                        logger.error(response_json['messages'])
+                        self.check_model_rejected(response_json['messages'], data['model_id'])
+                        raise Exception("Snipe returned an error during the transaction.")
+                    logger.info(f"Updated asset {data['asset_tag']} with serial {serial_number} and ID {row['id']}")
+                    # Merge what we sent, the update payload is the raw model and lacks the assigned_to details
+                    return self.assets.update(serial_number, {key: data[key] for key in ["asset_tag", "notes", "name"]})
+                else:
+                    logger.error("Problem updating Snipe asset!")
+                    raise Exception("Problem updating Snipe asset!")
+            else:
+                logger.debug(f"Asset already exists in snipe as ID {row['id']}, no update required")
+                return row
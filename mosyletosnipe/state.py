@@ -0,0 +1,149 @@
+#
+# Copyright (c) Michael Kelly. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for details.
+#
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+from mosyletosnipe.util import normalize_serial
+
+
+class SyncStateStore:
+    """
+    SQLite record of what we last pushed to Snipe for each serial number, so devices that haven't changed
+    in Mosyle since the last run can be skipped without making any Snipe requests.
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS devices (serial TEXT PRIMARY KEY, fingerprint TEXT NOT NULL, "
+                                "asset_id INTEGER, user_id INTEGER, snipe_updated_at TEXT, synced_at REAL)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS checkpoint_devices (serial TEXT PRIMARY KEY)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS failed_devices (serial TEXT PRIMARY KEY, platform TEXT NOT NULL, "
+                                "device TEXT NOT NULL, error TEXT, failed_at REAL)")
+        self.connection.commit()
+
+    @staticmethod
+    def fingerprint(data, useremail):
+        values = dict(data, useremail=useremail)
+        return hashlib.sha256(json.dumps(values, sort_keys=True).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def snipe_timestamp(row):
+        if row is None or row.get('updated_at') is None:
+            return None
+        return json.dumps(row['updated_at'], sort_keys=True)
+
+    def is_unchanged(self, serial_number, fingerprint, asset_index=None):
+        with self.lock:
+            stored = self.connection.execute("SELECT fingerprint, snipe_updated_at FROM devices WHERE serial = ?",
+                                             (normalize_serial(serial_number),)).fetchone()
+        if stored is None or stored[0] != fingerprint:
+            return False
+
+        if asset_index is not None and asset_index.loaded:
+            # Someone edited (or deleted) the asset in Snipe since we last saw it, so it needs a full pass
+            current = self.snipe_timestamp(asset_index.get(serial_number))
+            if current is None or current != stored[1]:
+                return False
+
+        return True
+
+    def record(self, serial_number, fingerprint, row):
+        assigned_to = row.get('assigned_to')
+        user_id = assigned_to['id'] if assigned_to is not None else None
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO devices VALUES (?, ?, ?, ?, ?, ?)",
+                                    (normalize_serial(serial_number), fingerprint, row['id'], user_id,
+                                     self.snipe_timestamp(row), time.time()))
+            self.connection.execute("DELETE FROM failed_devices WHERE serial = ?", (normalize_serial(serial_number),))
+            self.pending += 1
+            if self.pending >= 100:
+                self.connection.commit()
+                self.pending = 0
+
+    def forget(self, serial_number=None):
+        # Drops one serial, or everything, so it gets a full pass next time
+        with self.lock:
+            if serial_number is None:
+                self.connection.execute("DELETE FROM devices")
+            else:
+                self.connection.execute("DELETE FROM devices WHERE serial = ?", (normalize_serial(serial_number),))
+            self.connection.commit()
+
+    def full_reconcile_due(self, interval_hours):
+        if interval_hours <= 0:
+            return False
+        with self.lock:
+            stored = self.connection.execute("SELECT value FROM meta WHERE key = 'last_full_reconcile'").fetchone()
+        return stored is None or time.time() - float(stored[0]) >= interval_hours * 3600
+
+    def mark_full_reconcile(self):
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('last_full_reconcile', ?)", (str(time.time()),))
+            self.connection.commit()
+
+    def record_failure(self, serial_number, platform_key, device, error):
+        # Keeps the Mosyle details of a device that couldn't be synced, so a resumed sync can retry it
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO failed_devices VALUES (?, ?, ?, ?, ?)",
+                                    (normalize_serial(serial_number), platform_key, json.dumps(device), str(error),
+                                     time.time()))
+            self.connection.commit()
+
+    def failed_devices(self):
+        with self.lock:
+            rows = self.connection.execute("SELECT platform, device FROM failed_devices ORDER BY failed_at").fetchall()
+        return [(platform_key, json.loads(device)) for platform_key, device in rows]
+
+    def clear_failures(self):
+        with self.lock:
+            self.connection.execute("DELETE FROM failed_devices")
+            self.connection.commit()
+
+    def confirm(self, serial_number):
+        # Marks the serial as done for the sync in the checkpoint, it is committed with the next batch
+        with self.lock:
+            self.connection.execute("INSERT OR IGNORE INTO checkpoint_devices VALUES (?)",
+                                    (normalize_serial(serial_number),))
+
+    def save_checkpoint(self, checkpoint):
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('checkpoint', ?)", (json.dumps(checkpoint),))
+            self.connection.commit()
+            self.pending = 0
+
+    def load_checkpoint(self):
+        # Returns the checkpoint of an unfinished sync (or None) and the serials it already confirmed
+        with self.lock:
+            stored = self.connection.execute("SELECT value FROM meta WHERE key = 'checkpoint'").fetchone()
+            if stored is None:
+                return None, set()
+            serials = {row[0] for row in self.connection.execute("SELECT serial FROM checkpoint_devices")}
+        return json.loads(stored[0]), serials
+
+    def clear_checkpoint(self):
+        with self.lock:
+            self.connection.execute("DELETE FROM meta WHERE key = 'checkpoint'")
+            self.connection.execute("DELETE FROM checkpoint_devices")
+            self.connection.commit()
+            self.pending = 0
+
+    def commit(self):
+        with self.lock:
+            self.connection.commit()
+            self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
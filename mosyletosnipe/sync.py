@@ -0,0 +1,675 @@
+#
+# Copyright (c) Michael Kelly. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for details.
+#
+
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from loguru import logger
+
+from mosyletosnipe.metrics import SyncMetrics
+from mosyletosnipe.mosyle import MosyleClient, MosyleDevice
+from mosyletosnipe.snipe import SnipeClient, SnipeInventory
+from mosyletosnipe.state import SyncStateStore
+from mosyletosnipe.util import KeyedLocks, normalize_serial
+
+PLATFORMS = [
+    {"name": "iOS", "key": "ios", "mosyle_os": "ios", "checkout": True},
+    {"name": "macOS", "key": "macos", "mosyle_os": "mac", "checkout": True},
+    {"name": "tvOS", "key": "tvos", "mosyle_os": "tvos", "checkout": False}
+]
+
+
+def new_stats():
+    return {"devices": 0, "unchanged": 0, "resumed": 0, "synced": 0, "reassigned": 0, "failed": 0, "retried": 0,
+            "seconds": 0}
+
+
+def stream_devices(pages, depth=2):
+    # Downloads Mosyle pages on a background thread, so the next page is on its way while the workers handle this one
+    pages_queue = queue.Queue(maxsize=depth)
+    cancelled = threading.Event()
+
+    def put(item):
+        # Gives up once nobody is reading, instead of blocking on a full queue forever
+        while not cancelled.is_set():
+            try:
+                pages_queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for page in pages:
+                if not put(page):
+                    return
+            put(None)
+        except Exception as e:
+            put(e)
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            page = pages_queue.get()
+            if page is None:
+                return
+            if isinstance(page, Exception):
+                raise page
+            yield from page
+    finally:
+        # Runs when the generator is closed too, so a sync that stops early doesn't leave the thread downloading
+        cancelled.set()
+
+
+class PageCursor:
+    """
+    Tracks which Mosyle pages have had every one of their devices synced. next_page is the first page that hasn't,
+    which is where a resumed sync can pick the platform back up.
+    """
+
+    def __init__(self, next_page=1):
+        self.next_page = next_page
+        self.last_serial = None
+        self.pending = {}
+        self.pages = {}
+        self.lock = threading.Lock()
+
+    def track(self, pages):
+        for number, page in enumerate(pages, self.next_page):
+            with self.lock:
+                self.pending[number] = len(page)
+                for device in page:
+                    self.pages.setdefault(device.serial_number, []).append(number)
+            yield page
+
+    def done(self, serial_number):
+        with self.lock:
+            numbers = self.pages.get(serial_number)
+            if not numbers:
+                return
+            number = numbers.pop(0)
+            if not numbers:
+                del self.pages[serial_number]
+            self.pending[number] -= 1
+            self.last_serial = serial_number
+            while self.pending.get(self.next_page) == 0:
+                del self.pending[self.next_page]
+                self.next_page += 1
+
+
+class SnipeSync:
+    """
+    Syncs Mosyle devices into Snipe for one config. The Mosyle and Snipe clients, the Snipe indexes and the sync
+    state are only set up the first time something needs them, so syncing a single device logs in and fetches
+    no more than that device needs. State and cache files are relative to config_dir.
+    Everything is kept between syncs, so one instance can sync over and over with warm connections and indexes.
+    """
+
+    def __init__(self, config, config_dir="."):
+        self.config = config
+        self.config_dir = config_dir
+        self.workers = config['snipe'].get('workers', 1)
+        self.metrics = SyncMetrics({"tenant": config['tenant']} if 'tenant' in config else None)
+        self.full_reconcile = True
+        self.snipe_checked = False
+        self.stopping = threading.Event()
+        self.checkpoint = None
+        self.checkpoint_saved = 0
+        # The last sync stopped part way through and left its checkpoint for --resume
+        self.checkpoint_kept = False
+        self.checkpoint_lock = threading.Lock()
+        self.cursors = {}
+        self.confirmed = set()
+        self.retry_queue = []
+        # Platforms whose device list couldn't all be retrieved from Mosyle during the last sync
+        self.incomplete = set()
+        self.serial_locks = KeyedLocks()
+        self.stats_lock = threading.Lock()
+        self.lock = threading.RLock()
+        self._mosyle = None
+        self._snipe = None
+        self._inventory = None
+        self._state = None
+
+    def path(self, key, default):
+        # Relative paths are next to config.json, an empty setting turns the file off
+        value = self.config.get(key, default)
+        if not value:
+            return None
+        return os.path.join(self.config_dir, value)
+
+    @property
+    def mosyle(self):
+        with self.lock:
+            if self._mosyle is None:
+                logger.info("Trying to setup Mosyle connection")
+                mosyle = MosyleClient(self.config['mosyle'], self.metrics)
+                if not mosyle.retrieve_jwt():
+                    raise Exception("Unable to successfully obtain a JWT from Mosyle; Check credentials!")
+                self._mosyle = mosyle
+            return self._mosyle
+
+    @property
+    def snipe(self):
+        with self.lock:
+            if self._snipe is None:
+                # Each platform running at once has its own workers, they all need a connection
+                parallel = len(self.platforms()) if self.config['snipe'].get('concurrent_platforms', True) else 1
+                self._snipe = SnipeClient(self.config['snipe'], self.metrics, self.workers,
+                                          self.workers * max(1, parallel))
+            return self._snipe
+
+    @property
+    def inventory(self):
+        with self.lock:
+            if self._inventory is None:
+                self._inventory = SnipeInventory(self.snipe, self.config['snipe'],
+                                                 self.path('model_cache_file', "models.json"),
+                                                 self.config.get('model_cache_hours', 24))
+                # Reading the saved models costs nothing, fetching them from Snipe is left to prefetch()
+                self._inventory.models.load_from_disk()
+            return self._inventory
+
+    @property
+    def state(self):
+        with self.lock:
+            if self._state is None and self.path('state_file', "state.db"):
+                self._state = SyncStateStore(self.path('state_file', "state.db"))
+            return self._state
+
+    def check_snipe_connection(self):
+        # Just a blank search to verify the credentials are valid
+        logger.info("Trying to setup Snipe connection")
+        response = self.snipe.get("/models?limit=1&offset=0&sort=created_at&order=asc")
+        if response.status_code != 200:
+            logger.error(f"Received HTTP error {response.status_code}")
+            raise Exception("Unable to successfully connect to the Snipe API!")
+
+    def prefetch(self, refresh=False):
+        snipe_config = self.config['snipe']
+        page_size = snipe_config.get('prefetch_page_size', 500)
+        inventory = self.inventory
+
+        # Between syncs the indexes are kept up to date by our own changes, only refetch them now and then
+        def expired(loaded_at):
+            return refresh or time.time() - loaded_at >= self.config.get('cache_refresh_hours', 24) * 3600
+
+        # Prefetch every Snipe asset once so the per device lookups don't need a request
+        if snipe_config.get('prefetch_assets', True) and expired(inventory.assets.loaded_at):
+            with self.metrics.phase("asset_prefetch"):
+                prefetched = inventory.assets.load(page_size)
+            if not prefetched:
+                logger.warning("Unable to prefetch Snipe assets, falling back to per device lookups")
+        elif inventory.assets.loaded:
+            # Still fresh, but assets edited in Snipe since the last sync need checking again
+            with self.metrics.phase("asset_refresh"):
+                refreshed = inventory.assets.refresh(page_size)
+            if not refreshed:
+                logger.warning("Unable to refresh the Snipe assets, they will be fetched again next sync")
+                inventory.assets.loaded_at = 0
+
+        # Load the Apple models, from the on-disk cache if it is still fresh and this isn't a full reconcile
+        if expired(inventory.models.loaded_at):
+            with self.metrics.phase("model_preload"):
+                prefetched = inventory.models.load(page_size, snipe_config['apple_manufacturer_id'], refresh)
+            if not prefetched:
+                logger.warning("Unable to prefetch Snipe models, falling back to per model lookups")
+
+        # Prefetch the user directory too, only needed when we are checking devices out
+        if snipe_config['checkout_devices'] and snipe_config.get('prefetch_users', True) and \
+                expired(inventory.users.loaded_at):
+            with self.metrics.phase("user_prefetch"):
+                prefetched = inventory.users.load(page_size)
+            if not prefetched:
+                logger.warning("Unable to prefetch Snipe users, falling back to per user lookups")
+
+    def platforms(self, keys=None):
+        # Platforms asked for by name are synced even if their import_ setting is off
+        if keys:
+            return [platform for platform in PLATFORMS if platform['key'] in keys]
+        return [platform for platform in PLATFORMS if self.config['snipe'][f"import_{platform['key']}"]]
+
+    def count(self, stats, key, amount=1):
+        with self.stats_lock:
+            stats[key] += amount
+
+    def run_device_workers(self, devices, process_device, serial_of=None):
+        # Returns True if every device was handed to a worker
+        # Only a few devices per worker are queued at once, so memory stays flat however big the fleet is
+        in_flight = threading.BoundedSemaphore(self.workers * 4)
+
+        def process_in_order(device):
+            serial_number = serial_of(device) if serial_of is not None else device.serial_number
+            try:
+                # Keeps the upsert -> checkin -> checkout sequence for a serial together, even if Mosyle lists it twice
+                with self.serial_locks.hold(normalize_serial(serial_number)):
+                    process_device(device)
+            except Exception as e:
+                logger.error(f"Exception raised while processing device {serial_number}")
+                logger.error("Will be skipped!")
+                logger.debug(e)
+            finally:
+                in_flight.release()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            try:
+                for device in devices:
+                    # Asked to stop, let the devices already handed out finish and leave the rest for next time
+                    if self.interrupted():
+                        return False
+                    in_flight.acquire()
+                    executor.submit(process_in_order, device)
+            except Exception as e:
+                logger.error("Unable to retrieve all devices from Mosyle, the remaining devices will be skipped!")
+                logger.debug(e)
+                return False
+        return True
+
+    def sync_device(self, platform, device, checkout, stats, force=False):
+        self.count(stats, "devices")
+
+        # Already done by the interrupted sync we are resuming
+        if not force and normalize_serial(device.serial_number) in self.confirmed:
+            self.count(stats, "resumed")
+            return
+
+        try:
+            self.push_device(platform, device, checkout, stats, force)
+        except Exception as e:
+            logger.error(f"Exception raised while processing device {device.serial_number}: {e}")
+            logger.error("Will be retried later!")
+            self.count(stats, "failed")
+            self.device_failed(platform, device, checkout, e, True)
+
+    def push_device(self, platform, device, checkout, stats, force=False):
+        snipe_config = self.config['snipe']
+        inventory = self.inventory
+
+        with self.metrics.phase("model_resolution"):
+            snipe_model_id = inventory.get_or_create_model(device.device_model_name, device.device_model,
+                                                           snipe_config[f"{platform['key']}_category_id"])
+
+        data = {
+            "archived": False,
+            "supplier_id": snipe_config['apple_supplier_id'],
+            "asset_tag": device.asset_tag,
+            "status_id": snipe_config['default_status_id'],
+            "model_id": snipe_model_id,
+            "name": device.device_name,
+            "serial": device.serial_number,
+            "notes": device.open_direct_device_link
+        }
+
+        # Nothing we'd send has changed since the last run, so there is nothing to do in Snipe
+        fingerprint = SyncStateStore.fingerprint(data, device.useremail if checkout else None)
+        if not force and not self.full_reconcile and self.state is not None and \
+                self.state.is_unchanged(device.serial_number, fingerprint, inventory.assets):
+            logger.debug(f"Device {device.serial_number} is unchanged since the last sync")
+            self.count(stats, "unchanged")
+            return
+
+        with self.metrics.phase("upsert"):
+            snipe_device_details = inventory.create_or_update_asset(device.serial_number, data)
+
+        if checkout:
+            if device.useremail.strip() == "":
+                # Device is not checked out
+                # Make sure it is checked in in Snipe
+                snipe_user_id = 0
+            else:
+                # Get the snipe ID to checkout to
+                with self.metrics.phase("user_resolution"):
+                    snipe_user_id = inventory.get_or_create_user(device.first_name, device.last_name,
+                                                                 device.useremail, device.useremail)
+
+            # Only talks to Snipe when the assignment actually differs
+            with self.metrics.phase("checkout"):
+                reassigned = inventory.sync_assignment(snipe_device_details, snipe_user_id)
+            if reassigned:
+                self.count(stats, "reassigned")
+
+        if self.state is not None:
+            self.state.record(device.serial_number, fingerprint, snipe_device_details)
+            if self.checkpoint is not None:
+                self.state.confirm(device.serial_number)
+        self.count(stats, "synced")
+
+    def device_failed(self, platform, device, checkout, error, counted):
+        # Our copy of the asset can't be trusted any more, and the device goes on the retry queue
+        self.inventory.assets.discard(device.serial_number)
+        if self.state is not None:
+            self.state.forget(device.serial_number)
+            self.state.record_failure(device.serial_number, platform['key'], device.to_dict(), error)
+        with self.stats_lock:
+            self.retry_queue.append({"platform": platform, "device": device, "checkout": checkout, "counted": counted})
+
+    def retry_device(self, item, stats):
+        device = item['device']
+        self.count(stats, "retried")
+        try:
+            self.push_device(item['platform'], device, item['checkout'], stats, force=True)
+        except Exception as e:
+            logger.error(f"Retrying device {device.serial_number} failed again: {e}")
+            if not item['counted']:
+                self.count(stats, "failed")
+            self.device_failed(item['platform'], device, item['checkout'], e, True)
+            return
+        # It is synced after all, so it no longer counts as failed
+        if item['counted']:
+            self.count(stats, "failed", -1)
+
+    def retry_failed(self, results):
+        # Gives the devices that failed another go once the rest of the fleet is done, Snipe may have recovered by now
+        for attempt in range(self.config['snipe'].get('retry_failed_rounds', 1)):
+            if self.interrupted():
+                return
+            with self.stats_lock:
+                items, self.retry_queue = self.retry_queue, []
+            if len(items) == 0:
+                return
+
+            logger.info(f"Retrying {len(items)} devices that failed")
+            for item in items:
+                results.setdefault(item['platform']['name'], new_stats())
+            self.run_device_workers(iter(items), lambda item: self.retry_device(item, results[item['platform']['name']]),
+                                    lambda item: item['device'].serial_number)
+
+    def sync_platform(self, platform, serial_numbers=None, device_filter=None, force=False):
+        stats = new_stats()
+        # tvOS devices aren't usually assigned to people, so checking them out is opt in with checkout_tvos
+        checkout = self.config['snipe']['checkout_devices'] and \
+            self.config['snipe'].get(f"checkout_{platform['key']}", platform['checkout'])
+        started = time.monotonic()
+
+        # Only whole fleet syncs are checkpointed
+        cursor = None
+        if self.checkpoint is not None and serial_numbers is None and device_filter is None:
+            progress = self.checkpoint['platforms'].get(platform['key'], {})
+            if progress.get('done'):
+                logger.info(f"{platform['name']} devices were all synced before the sync was interrupted")
+                return stats
+            # Go back a page, devices removed from Mosyle since then will have moved the rest up
+            cursor = PageCursor(max(1, progress.get('page', 1) - 1))
+            with self.checkpoint_lock:
+                self.cursors[platform['key']] = cursor
+
+        def process(device):
+            try:
+                self.sync_device(platform, device, checkout, stats, force)
+            finally:
+                if cursor is not None:
+                    cursor.done(device.serial_number)
+                    self.save_checkpoint(periodic=True)
+
+        logger.info(f"Retrieving {platform['name']} devices from Mosyle")
+        pages = self.mosyle.iter_device_pages(platform['mosyle_os'], serial_numbers,
+                                              cursor.next_page if cursor is not None else 1)
+        stream = stream_devices(cursor.track(pages) if cursor is not None else pages)
+        devices = stream
+        if device_filter is not None:
+            devices = (device for device in stream if device_filter(device))
+        try:
+            completed = self.run_device_workers(devices, process)
+        finally:
+            stream.close()
+        if not completed and not self.interrupted():
+            # Not asked to stop, so Mosyle failed part way through the list
+            with self.stats_lock:
+                self.incomplete.add(platform['name'])
+
+        if cursor is not None and completed:
+            with self.checkpoint_lock:
+                self.checkpoint['platforms'].setdefault(platform['key'], {})['done'] = True
+            self.save_checkpoint()
+
+        stats['seconds'] = round(time.monotonic() - started, 1)
+        logger.info(f"Finished syncing {platform['name']} devices")
+        return stats
+
+    def start_checkpoint(self, full_reconcile=False, resume=False):
+        # Returns True if an interrupted sync is being resumed
+        checkpoint = None
+        if resume:
+            checkpoint, self.confirmed = self.state.load_checkpoint()
+            if checkpoint is None:
+                logger.info("There is no interrupted sync to resume, starting a new one")
+        resumed = checkpoint is not None
+
+        if checkpoint is None:
+            self.full_reconcile = full_reconcile or \
+                self.state.full_reconcile_due(self.config.get('full_reconcile_hours', 168))
+            checkpoint = {"started": time.time(), "full_reconcile": self.full_reconcile, "platforms": {}}
+            self.confirmed = set()
+            self.state.clear_checkpoint()
+            self.state.clear_failures()
+        else:
+            started = datetime.fromtimestamp(checkpoint['started']).strftime("%Y-%m-%d %H:%M:%S")
+            logger.info(f"Resuming the sync started at {started}, {len(self.confirmed)} devices are already done")
+            self.full_reconcile = checkpoint['full_reconcile']
+            if 'users' in checkpoint:
+                self.inventory.users.restore(checkpoint['users'], checkpoint['saved_at'])
+            # Devices that failed before the interruption are retried at the end, wherever they were in Mosyle
+            platforms = {platform['key']: platform for platform in PLATFORMS}
+            for platform_key, device in self.state.failed_devices():
+                platform = platforms[platform_key]
+                checkout = self.config['snipe']['checkout_devices'] and \
+                    self.config['snipe'].get(f"checkout_{platform_key}", platform['checkout'])
+                self.retry_queue.append({"platform": platform, "device": MosyleDevice(device), "checkout": checkout,
+                                         "counted": False})
+
+        with self.checkpoint_lock:
+            self.checkpoint = checkpoint
+            self.cursors = {}
+        self.save_checkpoint()
+        return resumed
+
+    def save_checkpoint(self, periodic=False):
+        with self.checkpoint_lock:
+            if self.checkpoint is None:
+                return
+            if periodic and time.monotonic() - self.checkpoint_saved < self.config.get('checkpoint_seconds', 60):
+                return
+            self.checkpoint_saved = time.monotonic()
+
+            for key, cursor in self.cursors.items():
+                self.checkpoint['platforms'].setdefault(key, {}).update(page=cursor.next_page,
+                                                                        serial=cursor.last_serial)
+            # Saves the user directory prefetch when resuming, the model catalog already has its own cache file
+            if self._inventory is not None and self._inventory.users.loaded:
+                self.checkpoint['users'] = dict(self._inventory.users.ids)
+            self.checkpoint['saved_at'] = time.time()
+            self.state.save_checkpoint(self.checkpoint)
+
+    def finish_checkpoint(self, platforms):
+        # Returns True if every platform was synced to the end
+        with self.checkpoint_lock:
+            checkpoint = self.checkpoint
+            finished = checkpoint is not None and not self.interrupted() and \
+                all(checkpoint['platforms'].get(platform['key'], {}).get('done') for platform in platforms)
+        self.checkpoint_kept = checkpoint is not None and not finished
+        if checkpoint is None:
+            return False
+        if not finished:
+            # Stopped (or Mosyle failed) part way through, leave the checkpoint for --resume
+            self.save_checkpoint()
+            if not self.aborted:
+                logger.warning("The sync didn't finish, run it with --resume to carry on")
+        else:
+            self.state.clear_checkpoint()
+        with self.checkpoint_lock:
+            self.checkpoint = None
+            self.cursors = {}
+        return finished
+
+    def sync_platforms(self, platforms, serial_numbers=None, device_filter=None, force=False):
+        # Log in before the platforms start, so bad credentials stop the run instead of every platform
+        self.mosyle
+        self.incomplete = set()
+
+        # The platforms share the Snipe client (and its rate budget) and the model cache, so they can run side by side
+        parallel = len(platforms) if self.config['snipe'].get('concurrent_platforms', True) else 1
+        with ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+            results = executor.map(lambda platform: self.sync_platform(platform, serial_numbers, device_filter, force),
+                                   platforms)
+            return {platform['name']: stats for platform, stats in zip(platforms, results)}
+
+    def sync_all(self, platform_keys=None, full_reconcile=False, resume=False):
+        """
+        Full fleet sync: prefetches the Snipe indexes, syncs every device and writes out the run metrics.
+        Progress is checkpointed in the state file, with resume=True an interrupted sync carries on where it stopped.
+        """
+        self.metrics.reset()
+        self.inventory.users.reset_counts()
+        self.snipe.breaker.reset()
+        self.retry_queue = []
+        resumed = False
+        if self.state is not None:
+            resumed = self.start_checkpoint(full_reconcile, resume)
+        else:
+            # Every device gets a full pass without a state file anyway, the indexes are refetched when they are
+            # cache_refresh_hours old or asked for with full_reconcile
+            self.full_reconcile = full_reconcile
+            if resume:
+                logger.warning("There is no state_file to keep a checkpoint in, starting a new sync")
+        if self.full_reconcile:
+            logger.info("Running a full reconcile, every device will be checked against Snipe")
+
+        # Log in to both services before spending any time on the prefetch
+        self.mosyle
+        if not self.snipe_checked:
+            self.check_snipe_connection()
+            self.snipe_checked = True
+        # A resumed reconcile already fetched fresh indexes before it was interrupted
+        self.prefetch(refresh=self.full_reconcile and not resumed)
+
+        platforms = self.platforms(platform_keys)
+        results = self.sync_platforms(platforms)
+        self.retry_failed(results)
+        self.report(results)
+        self.export_metrics(results)
+        if self.state is not None:
+            # A reconcile that didn't get through every platform doesn't count
+            if self.finish_checkpoint(platforms) and self.full_reconcile:
+                self.state.mark_full_reconcile()
+            self.state.commit()
+        return results
+
+    def run_daemon(self, interval_minutes, platform_keys=None, full_reconcile=False, resume=False):
+        """
+        Runs sync_all() every interval_minutes until stop() is called. A failed sync is logged and tried again at
+        the next interval. The Snipe indexes are only refetched every cache_refresh_hours or on a full reconcile.
+        """
+        logger.info(f"Syncing every {interval_minutes} minutes")
+        while not self.stopping.is_set():
+            started = time.monotonic()
+            try:
+                self.sync_all(platform_keys, full_reconcile, resume)
+            except Exception as e:
+                logger.error(f"Sync failed, trying again in {interval_minutes} minutes: {e}")
+            full_reconcile = False
+            resume = False
+
+            wait = interval_minutes * 60 - (time.monotonic() - started)
+            if wait <= 0:
+                logger.warning(f"The sync took longer than {interval_minutes} minutes, starting the next one now")
+            elif not self.stopping.is_set():
+                logger.info(f"Next sync in {wait / 60:.1f} minutes")
+                self.stopping.wait(wait)
+        logger.info("Stopped syncing")
+
+    def stop(self):
+        # Safe to call from a signal handler, the current sync finishes the devices it has started and returns
+        self.stopping.set()
+        if self._snipe is not None:
+            # Don't sit out a Snipe outage when we are meant to be stopping
+            self._snipe.breaker.cancel()
+
+    @property
+    def aborted(self):
+        # The circuit breaker gave up on Snipe during the last sync
+        return self._snipe is not None and self._snipe.breaker.aborted
+
+    def interrupted(self):
+        return self.stopping.is_set() or self.aborted
+
+    def sync_serials(self, serial_numbers, platform_keys=None):
+        """
+        Syncs just these serial numbers, whatever the sync state says. Nothing is prefetched from Snipe.
+        """
+        wanted = {normalize_serial(serial_number) for serial_number in serial_numbers}
+        found = set()
+
+        def seen(device):
+            found.add(normalize_serial(device.serial_number))
+            return True
+
+        results = self.sync_platforms(self.platforms(platform_keys), sorted(wanted), seen, force=True)
+        for serial_number in sorted(wanted - found):
+            logger.warning(f"Device {serial_number} was not found in Mosyle")
+        self.report(results)
+        return results
+
+    def sync_user(self, email, platform_keys=None):
+        """
+        Syncs the devices Mosyle has assigned to this user, whatever the sync state says. Mosyle can't filter
+        the device list by user, so every page is still listed but only the user's devices reach Snipe.
+        """
+        email = email.strip().lower()
+
+        def assigned(device):
+            return device.useremail.strip().lower() == email
+
+        results = self.sync_platforms(self.platforms(platform_keys), device_filter=assigned, force=True)
+        if sum(stats['devices'] for stats in results.values()) == 0:
+            logger.warning(f"No devices are assigned to {email} in Mosyle")
+        self.report(results)
+        return results
+
+    def report(self, results):
+        for name, stats in results.items():
+            logger.info(f"{name}: {stats['devices']} devices in {stats['seconds']}s ({stats['synced']} synced, "
+                        f"{stats['unchanged']} unchanged, {stats['resumed']} done before resuming, "
+                        f"{stats['reassigned']} reassigned, {stats['retried']} retried, {stats['failed']} failed)")
+        for name in sorted(self.incomplete):
+            logger.error(f"Not every {name} device could be retrieved from Mosyle, the rest of them weren't synced")
+        if self._inventory is not None:
+            logger.info(f"User lookups: {self._inventory.users.hits} cache hits, {self._inventory.users.misses} misses")
+
+        if self._snipe is not None:
+            circuit = self._snipe.breaker.summary()
+            if circuit['opens'] > 0:
+                logger.warning(f"Snipe was failing: the circuit breaker opened {circuit['opens']} times, "
+                               f"requests were held back for {circuit['paused_seconds']}s")
+            if circuit['aborted']:
+                logger.error("The sync was aborted because Snipe kept failing, run it again with --resume once "
+                             "Snipe has recovered")
+        if len(self.retry_queue) > 0:
+            serials = ", ".join(item['device'].serial_number for item in self.retry_queue[:10])
+            more = f" and {len(self.retry_queue) - 10} more" if len(self.retry_queue) > 10 else ""
+            logger.warning(f"{len(self.retry_queue)} devices are still waiting to be retried: {serials}{more}")
+
+    def export_metrics(self, results):
+        # Write out the run metrics, for dashboards and alerting
+        summary = self.metrics.summary(results)
+        if self._snipe is not None:
+            summary['circuit'] = self._snipe.breaker.summary()
+        for endpoint in summary['endpoints']:
+            logger.info(f"{endpoint['service']} {endpoint['method']} {endpoint['endpoint']}: {endpoint['requests']} "
+                        f"requests, p50 {endpoint['p50']}s, p95 {endpoint['p95']}s, p99 {endpoint['p99']}s")
+        if self.path('metrics_json', "metrics.json"):
+            self.metrics.export_json(self.path('metrics_json', "metrics.json"), summary)
+        if self.path('metrics_prometheus', "snipesync.prom"):
+            self.metrics.export_prometheus(self.path('metrics_prometheus', "snipesync.prom"), summary)
+        return summary
+
+    def close(self):
+        with self.lock:
+            if self._state is not None:
+                self._state.close()
+                self._state = None
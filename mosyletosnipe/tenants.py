@@ -0,0 +1,161 @@
+#
+# Copyright (c) Michael Kelly. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for details.
+#
+
+import json
+import multiprocessing
+import multiprocessing.connection
+import os
+import re
+import signal
+import threading
+import time
+from loguru import logger
+
+# Files every tenant needs its own copy of, with the name they get when nothing is configured
+TENANT_FILES = {
+    "state_file": "state.db",
+    "model_cache_file": "models.json",
+    "metrics_json": "metrics.json",
+    "metrics_prometheus": "snipesync.prom"
+}
+
+
+def tenant_file(path, name):
+    # state.db -> state-<name>.db, "" stays disabled
+    if not path:
+        return path
+    root, extension = os.path.splitext(path)
+    return f"{root}-{name}{extension}"
+
+
+def tenant_configs(config, names=None):
+    """
+    Builds a full config for each entry in config['tenants']: the top level settings with the tenant's own on top
+    (mosyle and snipe are merged key by key). Unless a tenant sets them, its state, cache and metrics files get its
+    name added, so no two tenants share one. Returns (name, config) pairs, only for names if they are given.
+    """
+    defaults = {key: value for key, value in config.items() if key != 'tenants'}
+    tenants = []
+    for entry in config['tenants']:
+        name = entry.get('name')
+        if not name or not re.match(r"^[A-Za-z0-9_.-]+$", str(name)):
+            raise Exception(f"Tenant names can only use letters, numbers, '.', '-' and '_', not {name!r}")
+        if name in dict(tenants):
+            raise Exception(f"Tenant {name} is configured more than once")
+
+        tenant = dict(defaults)
+        for key, value in entry.items():
+            if key in ("mosyle", "snipe"):
+                tenant[key] = dict(defaults.get(key, {}), **value)
+            elif key != "name":
+                tenant[key] = value
+        for key, default in TENANT_FILES.items():
+            if key not in entry:
+                tenant[key] = tenant_file(defaults.get(key, default), name)
+        tenant['tenant'] = name
+        tenants.append((name, tenant))
+
+    if names:
+        unknown = set(names) - set(dict(tenants))
+        if len(unknown) > 0:
+            raise Exception(f"Unknown tenant(s): {', '.join(sorted(unknown))}")
+        tenants = [(name, tenant) for name, tenant in tenants if name in names]
+    return tenants
+
+
+def failed_report(name, error, exit_code=1, seconds=0):
+    return {"tenant": name, "exit_code": exit_code, "results": {}, "seconds": seconds, "error": error,
+            "aborted": False}
+
+
+def run_tenants(tenants, target, max_parallel=4):
+    """
+    Runs target(name, config, connection) for each tenant in a process of its own, at most max_parallel at a time.
+    target sends its report down connection before it returns. Returns the reports by tenant name; a tenant that
+    died without sending one is reported as failed. SIGTERM or Ctrl+C stops the running tenants (which finish the
+    devices they started and save a checkpoint) and starts no more.
+    """
+    waiting = list(tenants)
+    running = {}
+    reports = {}
+    stopping = threading.Event()
+
+    def stop(signum, frame):
+        stopping.set()
+        for process, connection, started in list(running.values()):
+            process.terminate()
+
+    handlers = {signum: signal.signal(signum, stop) for signum in (signal.SIGTERM, signal.SIGINT)}
+    try:
+        while len(waiting) > 0 or len(running) > 0:
+            while len(waiting) > 0 and len(running) < max(1, max_parallel) and not stopping.is_set():
+                name, config = waiting.pop(0)
+                logger.info(f"Starting the sync for tenant {name}")
+                receiver, sender = multiprocessing.Pipe(duplex=False)
+                process = multiprocessing.Process(target=target, args=(name, config, sender), name=f"tenant-{name}")
+                process.start()
+                # Our copy of the sending end has to go, or the pipe never reports the tenant's process ending
+                sender.close()
+                running[name] = (process, receiver, time.monotonic())
+            if len(running) == 0:
+                break
+
+            # A pipe becomes readable when its tenant reports, or closes when the process dies
+            ready = multiprocessing.connection.wait([connection for process, connection, started in running.values()])
+            for name, (process, connection, started) in list(running.items()):
+                if connection not in ready:
+                    continue
+                try:
+                    reports[name] = connection.recv()
+                except EOFError:
+                    pass
+                process.join()
+                connection.close()
+                del running[name]
+                if name not in reports:
+                    reports[name] = failed_report(name, f"Exited with code {process.exitcode} without a report",
+                                                  process.exitcode or 1, round(time.monotonic() - started, 1))
+    finally:
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+
+    for name, config in waiting:
+        reports[name] = failed_report(name, "Not started, the run was stopped")
+    return reports
+
+
+def report_tenants(reports, path=None):
+    """
+    Logs one line per tenant and, if path is set, writes every tenant's report and the fleet totals to it as JSON.
+    """
+    totals = {}
+    for name, report in sorted(reports.items()):
+        tenant_totals = {}
+        for stats in report['results'].values():
+            for key, value in stats.items():
+                if key != "seconds":
+                    tenant_totals[key] = tenant_totals.get(key, 0) + value
+        for key, value in tenant_totals.items():
+            totals[key] = totals.get(key, 0) + value
+
+        if report['error'] is not None:
+            logger.error(f"Tenant {name} failed after {report['seconds']}s: {report['error']}")
+        elif report['exit_code'] != 0:
+            logger.warning(f"Tenant {name}: {tenant_totals.get('devices', 0)} devices in {report['seconds']}s "
+                           f"({tenant_totals.get('failed', 0)} failed{', Snipe circuit aborted' if report['aborted'] else ''})")
+        else:
+            logger.info(f"Tenant {name}: {tenant_totals.get('devices', 0)} devices in {report['seconds']}s "
+                        f"({tenant_totals.get('synced', 0)} synced, {tenant_totals.get('unchanged', 0)} unchanged, "
+                        f"{tenant_totals.get('failed', 0)} failed)")
+
+    failed = sorted(name for name, report in reports.items() if report['exit_code'] != 0)
+    if len(failed) > 0:
+        logger.warning(f"{len(failed)} of {len(reports)} tenants did not sync cleanly: {', '.join(failed)}")
+
+    if path:
+        with open(f"{path}.tmp", "w") as report_file:
+            report_file.write(json.dumps({"finished": time.time(), "totals": totals, "failed": failed,
+                                          "tenants": reports}, indent=4))
+        os.replace(f"{path}.tmp", path)
@@ -0,0 +1,36 @@
+#
+# Copyright (c) Michael Kelly. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for details.
+#
+
+import threading
+from contextlib import contextmanager
+
+
+def normalize_serial(serial_number):
+    return serial_number.strip().upper()
+
+
+class KeyedLocks:
+    """
+    One lock per key (a serial number, a user email), created on first use and dropped once nobody holds it.
+    """
+
+    def __init__(self):
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def hold(self, key):
+        # Serializes work on one key across the worker threads
+        with self.lock:
+            entry = self.locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.locks[key]